@@ -0,0 +1,153 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+import metrics
+
+# 默认缓存目录，可通过环境变量覆盖
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "music-ai-agent", "audio")
+
+
+class AudioCache:
+    """基于内容哈希的磁盘音频缓存（按大小和时间做LRU淘汰）"""
+
+    def __init__(self, cache_dir=None, max_bytes=None, max_age_seconds=None):
+        self.cache_dir = cache_dir or os.getenv("MUSIC_CACHE_DIR", DEFAULT_CACHE_DIR)
+        if max_bytes is None:
+            max_bytes = int(os.getenv("MUSIC_CACHE_MAX_MB", "1024")) * 1024 * 1024
+        if max_age_seconds is None:
+            max_age_seconds = int(os.getenv("MUSIC_CACHE_MAX_AGE", str(7 * 24 * 3600)))
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(prompt, max_new_tokens, temperature, seed, model_id):
+        """根据生成参数计算缓存键"""
+        payload = json.dumps(
+            {
+                "prompt": prompt,
+                "max_new_tokens": int(max_new_tokens),
+                "temperature": float(temperature),
+                "seed": seed,
+                "model_id": model_id,
+            },
+            ensure_ascii=False,
+            sort_keys=True,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.wav")
+
+    def get(self, key):
+        """命中时返回缓存文件路径，否则返回None"""
+        path = self._path(key)
+        with self._lock:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                self.misses += 1
+                metrics.inc("cache_requests_total", cache="audio", result="miss")
+                return None
+
+            if self.max_age_seconds and time.time() - stat.st_mtime > self.max_age_seconds:
+                # 已过期，直接删除
+                self._remove(path)
+                self.misses += 1
+                metrics.inc("cache_requests_total", cache="audio", result="miss")
+                return None
+
+            # 更新访问时间，用于LRU排序
+            os.utime(path, None)
+            self.hits += 1
+            metrics.inc("cache_requests_total", cache="audio", result="hit")
+            return path
+
+    def contains(self, key):
+        """是否有未过期的缓存条目（不计入命中统计，不更新访问时间）"""
+        try:
+            stat = os.stat(self._path(key))
+        except FileNotFoundError:
+            return False
+        return not (self.max_age_seconds and time.time() - stat.st_mtime > self.max_age_seconds)
+
+    def get_copy(self, key, suffix=".wav", dir=None):
+        """命中时复制一份到临时文件返回，避免缓存淘汰影响调用方"""
+        path = self.get(key)
+        if path is None:
+            return None
+        with tempfile.NamedTemporaryFile(delete=False, suffix=suffix, dir=dir) as tmp_file:
+            filename = tmp_file.name
+        try:
+            shutil.copyfile(path, filename)
+        except FileNotFoundError:
+            # 复制过程中被其他进程淘汰
+            os.remove(filename)
+            return None
+        return filename
+
+    def put(self, key, source_file):
+        """原子地把音频文件写入缓存"""
+        path = self._path(key)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as dst, open(source_file, "rb") as src:
+                shutil.copyfileobj(src, dst)
+                dst.flush()
+                os.fsync(dst.fileno())
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.evict()
+        return path
+
+    def evict(self):
+        """删除过期文件，并在超出容量时按最近使用时间淘汰"""
+        now = time.time()
+        entries = []
+        with self._lock:
+            for name in os.listdir(self.cache_dir):
+                if not name.endswith(".wav"):
+                    continue
+                path = os.path.join(self.cache_dir, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if self.max_age_seconds and now - stat.st_mtime > self.max_age_seconds:
+                    self._remove(path)
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+            total = sum(size for _, size, _ in entries)
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                self._remove(path)
+                total -= size
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def stats(self):
+        """返回命中统计"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
@@ -0,0 +1,145 @@
+import os
+import time
+import shutil
+import tempfile
+import threading
+import scipy.io.wavfile
+
+# 默认存储目录，可通过环境变量覆盖
+DEFAULT_STORE_DIR = os.path.join(tempfile.gettempdir(), "music-ai-agent")
+
+# 生成器先把文件写入 incoming，再由页面按会话认领
+INCOMING_DIR_NAME = "incoming"
+
+
+class AudioStore:
+    """生成音频的托管存储：按会话归属文件，总容量超限时按LRU淘汰，回收已结束会话的文件
+
+    目录结构为 <root>/<session_id>/<文件名>，重启后可直接从目录恢复归属关系。
+    """
+
+    def __init__(self, root_dir=None, max_bytes=None, incoming_ttl_seconds=3600,
+                 reclaim_interval_seconds=60):
+        self.root_dir = root_dir or os.getenv("MUSIC_STORE_DIR", DEFAULT_STORE_DIR)
+        if max_bytes is None:
+            max_bytes = int(os.getenv("MUSIC_STORE_MAX_MB", "512")) * 1024 * 1024
+        self.max_bytes = max_bytes
+        self.incoming_ttl_seconds = incoming_ttl_seconds
+        self.reclaim_interval_seconds = reclaim_interval_seconds
+        self.incoming_dir = os.path.join(self.root_dir, INCOMING_DIR_NAME)
+        self.evicted_files = 0
+        self.reclaimed_files = 0
+        self._last_reclaim = 0.0
+        self._lock = threading.Lock()
+        os.makedirs(self.incoming_dir, exist_ok=True)
+
+    def _session_dir(self, session_id):
+        # 会话ID来自Streamlit（uuid），这里仍做一次清洗避免路径穿越
+        safe_id = "".join(ch for ch in str(session_id) if ch.isalnum() or ch in "-_")
+        if not safe_id or safe_id == INCOMING_DIR_NAME:
+            raise ValueError(f"无效的会话ID: {session_id}")
+        return os.path.join(self.root_dir, safe_id)
+
+    def adopt(self, file_path, session_id):
+        """把生成器产出的文件移入会话目录，返回新路径"""
+        session_dir = self._session_dir(session_id)
+        if os.path.dirname(os.path.abspath(file_path)) == os.path.abspath(session_dir):
+            return file_path
+
+        os.makedirs(session_dir, exist_ok=True)
+        target = os.path.join(session_dir, os.path.basename(file_path))
+        try:
+            os.replace(file_path, target)
+        except OSError:
+            # 跨文件系统时退化为复制
+            shutil.copyfile(file_path, target)
+            os.remove(file_path)
+        self.enforce_quota(keep=target)
+        return target
+
+    def read(self, file_path):
+        """以内存映射方式读取WAV，返回 (采样率, 数据)，不把整个文件复制进内存"""
+        os.utime(file_path, None)
+        return scipy.io.wavfile.read(file_path, mmap=True)
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.root_dir):
+            session_dir = os.path.join(self.root_dir, name)
+            if name == INCOMING_DIR_NAME or not os.path.isdir(session_dir):
+                continue
+            for file_name in os.listdir(session_dir):
+                path = os.path.join(session_dir, file_name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path, name))
+        return entries
+
+    def usage(self):
+        """返回当前占用字节数"""
+        with self._lock:
+            return sum(size for _, size, _, _ in self._entries())
+
+    def enforce_quota(self, keep=None):
+        """总容量超限时删除最久未访问的文件"""
+        with self._lock:
+            entries = self._entries()
+            total = sum(size for _, size, _, _ in entries)
+            entries.sort()
+            for _, size, path, _ in entries:
+                if total <= self.max_bytes:
+                    break
+                if path == keep:
+                    continue
+                self._remove(path)
+                self.evicted_files += 1
+                total -= size
+
+    def release_session(self, session_id):
+        """删除某个会话的全部文件"""
+        session_dir = self._session_dir(session_id)
+        with self._lock:
+            if os.path.isdir(session_dir):
+                self.reclaimed_files += len(os.listdir(session_dir))
+                shutil.rmtree(session_dir, ignore_errors=True)
+
+    def reclaim(self, is_session_active, force=False):
+        """回收已结束会话的目录和 incoming 中的过期文件（按间隔节流）"""
+        now = time.time()
+        if not force and now - self._last_reclaim < self.reclaim_interval_seconds:
+            return
+        self._last_reclaim = now
+
+        for name in os.listdir(self.root_dir):
+            path = os.path.join(self.root_dir, name)
+            if name == INCOMING_DIR_NAME or not os.path.isdir(path):
+                continue
+            if not is_session_active(name):
+                self.release_session(name)
+
+        with self._lock:
+            for file_name in os.listdir(self.incoming_dir):
+                path = os.path.join(self.incoming_dir, file_name)
+                try:
+                    if now - os.stat(path).st_mtime > self.incoming_ttl_seconds:
+                        self._remove(path)
+                        self.reclaimed_files += 1
+                except FileNotFoundError:
+                    continue
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def stats(self):
+        """返回存储概况"""
+        return {
+            "bytes": self.usage(),
+            "max_bytes": self.max_bytes,
+            "evicted_files": self.evicted_files,
+            "reclaimed_files": self.reclaimed_files,
+        }
@@ -0,0 +1,314 @@
+import io
+import os
+import math
+import numpy as np
+import soundfile as sf
+
+
+def equal_power_crossfade(tail, head):
+    """等功率交叉淡化：tail 淡出、head 淡入，两段长度需一致"""
+    n = min(len(tail), len(head))
+    if n == 0:
+        return np.zeros(0, dtype=np.float32)
+    theta = np.linspace(0.0, np.pi / 2, n, dtype=np.float32)
+    return tail[-n:] * np.cos(theta) + head[:n] * np.sin(theta)
+
+
+# 页面交付用的压缩格式：(文件扩展名, MIME类型, soundfile格式, soundfile子类型)
+DELIVERY_FORMATS = {
+    "FLAC": ("flac", "audio/flac", "FLAC", "PCM_16"),
+    "OGG": ("ogg", "audio/ogg", "OGG", "VORBIS"),
+    "WAV": ("wav", "audio/wav", "WAV", "PCM_16"),
+}
+
+
+def encode_audio(data, sampling_rate, fmt="FLAC"):
+    """把波形编码为指定格式，返回内存中的字节"""
+    _, _, sf_format, subtype = DELIVERY_FORMATS[fmt]
+    buffer = io.BytesIO()
+    sf.write(buffer, data, sampling_rate, format=sf_format, subtype=subtype)
+    return buffer.getvalue()
+
+
+# 后处理按固定大小的块进行，峰值内存与音频时长无关
+POSTPROCESS_BLOCK_SIZE = 65536
+# 输出文件的采样格式：PCM_16 为16位整数，FLOAT 为32位浮点
+OUTPUT_SUBTYPES = ("PCM_16", "FLOAT")
+# 响度测量（ITU-R BS.1770）：100ms 分段，400ms 门限块，绝对门限 -70 LUFS，相对门限 -10 LU
+LOUDNESS_SEGMENT_SECONDS = 0.1
+LOUDNESS_GATE_SEGMENTS = 4
+ABSOLUTE_GATE_LUFS = -70.0
+RELATIVE_GATE_LU = -10.0
+
+
+def array_source(audio, block_size=POSTPROCESS_BLOCK_SIZE):
+    """把内存中的波形包装成块来源：每次调用返回一个新的块迭代器（切片视图，不复制）"""
+    audio = np.asarray(audio, dtype=np.float32).reshape(-1)
+    return lambda: (audio[start:start + block_size] for start in range(0, len(audio), block_size))
+
+
+def file_source(path, block_size=POSTPROCESS_BLOCK_SIZE):
+    """把音频文件包装成块来源，多声道取平均；返回 (块来源, 采样率)"""
+    sampling_rate = sf.info(path).samplerate
+
+    def blocks():
+        with sf.SoundFile(path) as f:
+            for block in f.blocks(blocksize=block_size, dtype="float32", always_2d=True):
+                yield block.mean(axis=1) if block.shape[1] > 1 else block[:, 0]
+    return blocks, sampling_rate
+
+
+def chord_blocks(duration_seconds, sampling_rate, block_size=POSTPROCESS_BLOCK_SIZE,
+                 notes=((261.63, 0.3), (329.63, 0.2), (392.00, 0.2))):
+    """逐块合成C大调和弦（C4、E4、G4），按全局采样序号计算相位，块间连续"""
+    total = int(duration_seconds * sampling_rate)
+    freqs = np.array([f for f, _ in notes], dtype=np.float64)[:, None]
+    amps = np.array([a for _, a in notes], dtype=np.float64)[:, None]
+    for start in range(0, total, block_size):
+        t = np.arange(start, min(start + block_size, total), dtype=np.float64) / sampling_rate
+        yield (amps * np.sin(2 * np.pi * freqs * t)).sum(axis=0).astype(np.float32)
+
+
+def _k_weighting_sos(sampling_rate):
+    """BS.1770 的K加权滤波器（高架 + 高通），按采样率计算的二阶节系数"""
+    sections = []
+    # 第一级：+4dB 高架，模拟头部的声学效应
+    gain, fc, q = 4.0, 1500.0, 0.7071752369554193
+    a = 10 ** (gain / 40)
+    w0 = 2 * np.pi * fc / sampling_rate
+    alpha = np.sin(w0) / (2 * q)
+    cos_w0 = np.cos(w0)
+    b = [a * ((a + 1) + (a - 1) * cos_w0 + 2 * np.sqrt(a) * alpha),
+         -2 * a * ((a - 1) + (a + 1) * cos_w0),
+         a * ((a + 1) + (a - 1) * cos_w0 - 2 * np.sqrt(a) * alpha)]
+    den = [(a + 1) - (a - 1) * cos_w0 + 2 * np.sqrt(a) * alpha,
+           2 * ((a - 1) - (a + 1) * cos_w0),
+           (a + 1) - (a - 1) * cos_w0 - 2 * np.sqrt(a) * alpha]
+    sections.append([x / den[0] for x in b] + [x / den[0] for x in den])
+    # 第二级：38Hz 高通（RLB加权）
+    fc, q = 38.0, 0.5003270373253953
+    w0 = 2 * np.pi * fc / sampling_rate
+    alpha = np.sin(w0) / (2 * q)
+    cos_w0 = np.cos(w0)
+    b = [(1 + cos_w0) / 2, -(1 + cos_w0), (1 + cos_w0) / 2]
+    den = [1 + alpha, -2 * cos_w0, 1 - alpha]
+    sections.append([x / den[0] for x in b] + [x / den[0] for x in den])
+    return np.array(sections)
+
+
+class _BlockResampler:
+    """分块多相重采样：每块带上前后各一段真实的相邻样本做上下文，结果与整段 resample_poly 一致"""
+
+    def __init__(self, orig_rate, target_rate):
+        g = math.gcd(int(orig_rate), int(target_rate))
+        self.up = int(target_rate) // g
+        self.down = int(orig_rate) // g
+        # resample_poly 默认滤波器在输入域的半宽约为 10*max(up,down)/up 个样本；上下文取 down 的整数倍
+        reach = 10 * max(self.up, self.down) / self.up + 2
+        self.context = self.down * math.ceil(reach / self.down)
+        self._history = np.zeros(0, dtype=np.float32)
+        self._pending = np.zeros(0, dtype=np.float32)
+
+    def feed(self, block):
+        """送入一块，返回已能确定的输出（右侧上下文不足的部分留到下一块）"""
+        self._pending = np.concatenate([self._pending, block])
+        n = (len(self._pending) - self.context) // self.down * self.down
+        if n <= 0:
+            return np.zeros(0, dtype=np.float32)
+        return self._emit(n)
+
+    def flush(self):
+        """输入结束，返回剩余输出"""
+        if not len(self._pending):
+            return np.zeros(0, dtype=np.float32)
+        return self._emit(len(self._pending))
+
+    def _emit(self, n):
+        from scipy.signal import resample_poly
+
+        left = self._history
+        chunk = np.concatenate([left, self._pending[:n + self.context]])
+        out = resample_poly(chunk, self.up, self.down)
+        start = len(left) * self.up // self.down
+        stop = start + -(-n * self.up // self.down)
+        self._history = np.concatenate([left, self._pending[:n]])[-self.context:]
+        self._pending = self._pending[n:]
+        return out[start:stop].astype(np.float32)
+
+
+class AudioPostProcessor:
+    """生成后的音频后处理：响度归一化、峰值限制、首尾静音裁剪、淡入淡出、重采样和导出
+
+    全程按块处理：第一遍测量响度、峰值和有声区间，第二遍逐块处理并写出，
+    内存占用只与块大小有关。各项可通过环境变量配置，MUSIC_POSTPROCESS=0 时只按原样导出。
+    """
+
+    def __init__(self, target_rate=None, target_lufs=None, peak_db=None, trim_db=None,
+                 fade_in_ms=None, fade_out_ms=None, subtype=None, block_size=POSTPROCESS_BLOCK_SIZE,
+                 enabled=None):
+        if enabled is None:
+            enabled = os.getenv("MUSIC_POSTPROCESS", "1") == "1"
+        if target_rate is None:
+            target_rate = int(os.getenv("MUSIC_OUTPUT_RATE", "44100")) if enabled else 0
+        if target_lufs is None:
+            target_lufs = float(os.getenv("MUSIC_TARGET_LUFS", "-16")) if enabled else None
+        if peak_db is None:
+            peak_db = float(os.getenv("MUSIC_PEAK_DB", "-1")) if enabled else None
+        if trim_db is None:
+            trim_db = float(os.getenv("MUSIC_TRIM_DB", "-60")) if enabled else None
+        if fade_in_ms is None:
+            fade_in_ms = float(os.getenv("MUSIC_FADE_IN_MS", "10")) if enabled else 0.0
+        if fade_out_ms is None:
+            fade_out_ms = float(os.getenv("MUSIC_FADE_OUT_MS", "50")) if enabled else 0.0
+        if subtype is None:
+            subtype = os.getenv("MUSIC_OUTPUT_SUBTYPE", "PCM_16")
+        if subtype not in OUTPUT_SUBTYPES:
+            raise ValueError(f"不支持的输出格式: {subtype}，可选 {OUTPUT_SUBTYPES}")
+        if target_rate and target_rate not in (44100, 48000):
+            raise ValueError(f"不支持的输出采样率: {target_rate}，可选 44100 / 48000（0 表示保持原采样率）")
+        self.target_rate = target_rate
+        self.target_lufs = target_lufs
+        self.peak_db = peak_db
+        self.trim_db = trim_db
+        self.fade_in_ms = fade_in_ms
+        self.fade_out_ms = fade_out_ms
+        self.subtype = subtype
+        self.block_size = block_size
+
+    @property
+    def tag(self):
+        """后处理配置的标识，用于区分缓存中不同配置的输出"""
+        return (f"post:{self.target_rate}/{self.target_lufs}/{self.peak_db}/{self.trim_db}/"
+                f"{self.fade_in_ms:g}-{self.fade_out_ms:g}/{self.subtype}")
+
+    def measure(self, blocks, sampling_rate):
+        """第一遍：返回 {"loudness", "peak", "start", "end", "samples"}，start/end 为有声区间"""
+        from scipy.signal import sosfilt
+
+        sos = _k_weighting_sos(sampling_rate)
+        zi = np.zeros((sos.shape[0], 2))
+        segment = max(1, int(round(LOUDNESS_SEGMENT_SECONDS * sampling_rate)))
+        energies = []
+        leftover = np.zeros(0)
+        threshold = 10 ** (self.trim_db / 20) if self.trim_db is not None else None
+        peak = 0.0
+        start = end = None
+        offset = 0
+        for block in blocks:
+            if not len(block):
+                continue
+            magnitude = np.abs(block)
+            peak = max(peak, float(magnitude.max()))
+            if threshold is not None:
+                loud = np.flatnonzero(magnitude > threshold)
+                if len(loud):
+                    if start is None:
+                        start = offset + int(loud[0])
+                    end = offset + int(loud[-1]) + 1
+            if self.target_lufs is not None:
+                weighted, zi = sosfilt(sos, block, zi=zi)
+                squared = np.concatenate([leftover, weighted * weighted])
+                whole = len(squared) // segment * segment
+                energies.append(squared[:whole].reshape(-1, segment).mean(axis=1))
+                leftover = squared[whole:]
+            offset += len(block)
+
+        loudness = None
+        if self.target_lufs is not None and offset:
+            loudness = self._gated_loudness(np.concatenate(energies) if energies else np.zeros(0), leftover)
+        if start is None:
+            # 没有裁剪或整段都低于门限时保留全部
+            start, end = 0, offset
+        return {"loudness": loudness, "peak": peak, "start": start, "end": end, "samples": offset}
+
+    @staticmethod
+    def _gated_loudness(segment_energies, leftover):
+        """按 BS.1770 门限计算整体响度（LUFS），静音返回None"""
+        if len(segment_energies) >= LOUDNESS_GATE_SEGMENTS:
+            kernel = np.full(LOUDNESS_GATE_SEGMENTS, 1.0 / LOUDNESS_GATE_SEGMENTS)
+            gate_blocks = np.convolve(segment_energies, kernel, mode="valid")
+        else:
+            # 不足一个门限块的短音频直接取整体均值
+            parts = [segment_energies] + ([leftover] if len(leftover) else [])
+            gate_blocks = np.array([np.concatenate(parts).mean()])
+        with np.errstate(divide="ignore"):
+            block_loudness = -0.691 + 10 * np.log10(gate_blocks)
+        gated = gate_blocks[block_loudness > ABSOLUTE_GATE_LUFS]
+        if not len(gated):
+            return None
+        relative_gate = -0.691 + 10 * np.log10(gated.mean()) + RELATIVE_GATE_LU
+        gated = gate_blocks[block_loudness > max(ABSOLUTE_GATE_LUFS, relative_gate)]
+        return float(-0.691 + 10 * np.log10(gated.mean()))
+
+    def process(self, source, sampling_rate, filename, fade_in_ms=None, fade_out_ms=None):
+        """处理块来源并写出到 filename，返回 {"sampling_rate", "samples", "loudness", "gain_db"}
+
+        source 为无参可调用对象，每次调用返回一个新的块迭代器（单声道 float32）；会被遍历两遍。
+        """
+        fade_in_ms = self.fade_in_ms if fade_in_ms is None else fade_in_ms
+        fade_out_ms = self.fade_out_ms if fade_out_ms is None else fade_out_ms
+        stats = self.measure(source(), sampling_rate)
+
+        gain = 1.0
+        if stats["loudness"] is not None:
+            gain = 10 ** ((self.target_lufs - stats["loudness"]) / 20)
+        if self.peak_db is not None and stats["peak"] > 0:
+            # 峰值限制优先于响度目标，避免削波
+            gain = min(gain, 10 ** (self.peak_db / 20) / stats["peak"])
+
+        start, end = stats["start"], stats["end"]
+        length = end - start
+        fade_in = min(int(fade_in_ms / 1000 * sampling_rate), length // 2)
+        fade_out = min(int(fade_out_ms / 1000 * sampling_rate), length // 2)
+        output_rate = self.target_rate or sampling_rate
+        resampler = _BlockResampler(sampling_rate, output_rate) if output_rate != sampling_rate else None
+
+        written = 0
+        with sf.SoundFile(filename, "w", samplerate=output_rate, channels=1, subtype=self.subtype,
+                          format="WAV") as out:
+            offset = 0
+            for block in source():
+                block_start, offset = offset, offset + len(block)
+                # 只保留有声区间内的部分
+                lo, hi = max(block_start, start), min(offset, end)
+                if lo >= hi:
+                    continue
+                chunk = block[lo - block_start:hi - block_start] * np.float32(gain)
+                position = np.arange(lo - start, hi - start)
+                if fade_in and position[0] < fade_in:
+                    chunk *= np.minimum(1.0, position / fade_in).astype(np.float32)
+                if fade_out and position[-1] >= length - fade_out:
+                    chunk *= np.minimum(1.0, (length - 1 - position) / fade_out).astype(np.float32)
+                written += self._write(out, resampler.feed(chunk) if resampler else chunk)
+            if resampler:
+                written += self._write(out, resampler.flush())
+
+        return {
+            "sampling_rate": output_rate,
+            "samples": written,
+            "loudness": stats["loudness"],
+            "gain_db": 20 * math.log10(gain) if gain > 0 else None,
+        }
+
+    def _write(self, out, chunk):
+        if not len(chunk):
+            return 0
+        np.clip(chunk, -1.0, 1.0, out=chunk)
+        if self.subtype == "PCM_16":
+            out.write(np.round(chunk * 32767).astype(np.int16))
+        else:
+            out.write(chunk)
+        return len(chunk)
+
+    def process_file(self, path, output_path=None):
+        """对已写出的音频文件做后处理；未指定 output_path 时原地替换"""
+        source, sampling_rate = file_source(path, self.block_size)
+        target = output_path or path
+        temp_path = target + ".post.wav"
+        try:
+            info = self.process(source, sampling_rate, temp_path)
+            os.replace(temp_path, target)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        return info
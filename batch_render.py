@@ -0,0 +1,254 @@
+"""批量离线渲染背景音乐
+
+从 JSONL 文件逐行读取任务（不整体载入内存），每行一个任务：
+  {"id": "cafe-01", "prompt": "轻松的咖啡馆背景音乐"}              先做需求分析再生成
+  {"id": "boss-02", "specs": {...}, "duration": 30, "seed": 7}     直接使用音乐需求
+  "悲伤的钢琴曲"                                                   只有描述时按内容生成稳定ID
+
+需求分析按限定的并发数调用大模型；生成请求同时交给生成器，未固定种子的由微批调度器合并成批推理，
+或者用 --workers 交给多进程任务池，按核心数扩展吞吐。每完成一条就写出音频并向清单追加一行，
+中断后重新运行会跳过清单中已完成的任务。
+
+用法：python -m batch_render prompts.jsonl --output-dir renders --analysis-concurrency 8 --workers auto
+"""
+import os
+import json
+import time
+import hashlib
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+MANIFEST_NAME = "manifest.jsonl"
+# 生成器先写到这里，完成后再原子地移到输出目录
+INCOMING_DIR_NAME = ".incoming"
+
+
+def read_tasks(path):
+    """逐行读取任务，返回任务字典的迭代器；无法解析的行带 error 字段"""
+    with open(path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                task = json.loads(line)
+            except json.JSONDecodeError as e:
+                yield {"id": f"line-{line_number}", "error": f"第 {line_number} 行无法解析: {e}"}
+                continue
+            if isinstance(task, str):
+                task = {"prompt": task}
+            if not isinstance(task, dict) or not (task.get("prompt") or task.get("specs")):
+                yield {"id": f"line-{line_number}", "error": f"第 {line_number} 行缺少 prompt 或 specs"}
+                continue
+            if not task.get("id"):
+                # 按内容生成ID，断点续跑时同一任务得到同一ID
+                content = json.dumps(task, sort_keys=True, ensure_ascii=False)
+                task["id"] = "task-" + hashlib.sha1(content.encode("utf-8")).hexdigest()[:12]
+            yield task
+
+
+def _safe_name(task_id):
+    return "".join(ch if ch.isalnum() or ch in "-_." else "_" for ch in str(task_id)).strip(".") or "task"
+
+
+class Manifest:
+    """追加写入的结果清单，每条结果一行；重新打开时找回已完成的任务"""
+
+    def __init__(self, path, output_dir):
+        self.path = path
+        self.output_dir = output_dir
+        self.completed = set()
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                data = f.read()
+            for line in data.decode("utf-8", errors="replace").splitlines():
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # 崩溃时可能留下半行
+                    continue
+                if entry.get("status") == "done" and os.path.exists(os.path.join(output_dir, entry["file"])):
+                    self.completed.add(entry["id"])
+            if data and not data.endswith(b"\n"):
+                # 补上换行，避免新记录接在半行后面
+                with open(path, "ab") as f:
+                    f.write(b"\n")
+
+    def record(self, entry):
+        """追加一条结果并立即落盘"""
+        line = json.dumps(entry, ensure_ascii=False) + "\n"
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            if entry["status"] == "done":
+                self.completed.add(entry["id"])
+
+
+class BatchRenderer:
+    """按任务流水线执行：需求分析（限并发）-> 生成（并发提交，由调度器或任务池合并）-> 写出并记入清单
+
+    render(specs, duration_seconds, seed) 返回 (文件路径, 提示词, 是否为生成失败时的备用音频)。
+    """
+
+    def __init__(self, analyze, render, output_dir, manifest, duration_seconds=20,
+                 seed=None, analysis_concurrency=8, generation_concurrency=4):
+        self.analyze = analyze
+        self.render = render
+        self.output_dir = output_dir
+        self.manifest = manifest
+        self.duration_seconds = duration_seconds
+        self.seed = seed
+        self.analysis_concurrency = analysis_concurrency
+        self.generation_concurrency = generation_concurrency
+        self.done = 0
+        self.failed = 0
+        self.skipped = 0
+        self.audio_seconds = 0.0
+        self._analysis_slots = threading.BoundedSemaphore(analysis_concurrency)
+        self._generation_slots = threading.BoundedSemaphore(generation_concurrency)
+        self._count_lock = threading.Lock()
+
+    def run(self, tasks):
+        """处理任务流，返回统计"""
+        start = time.perf_counter()
+        workers = self.analysis_concurrency + self.generation_concurrency
+        # 限制已读入但未完成的任务数，输入文件再大也只占用固定内存
+        in_flight = threading.BoundedSemaphore(workers * 2)
+        with ThreadPoolExecutor(workers, thread_name_prefix="batch-render") as pool:
+            for task in tasks:
+                if task["id"] in self.manifest.completed:
+                    self.skipped += 1
+                    continue
+                if "error" in task:
+                    self._record_failure(task, task["error"], 0.0)
+                    continue
+                in_flight.acquire()
+                future = pool.submit(self._process, task)
+                future.add_done_callback(lambda _: in_flight.release())
+        return self.stats(time.perf_counter() - start)
+
+    def _process(self, task):
+        start = time.perf_counter()
+        try:
+            specs = task.get("specs")
+            if specs is None:
+                with self._analysis_slots:
+                    specs = self.analyze(task["prompt"])
+            duration_seconds = int(task.get("duration") or self.duration_seconds)
+            seed = task.get("seed", self.seed)
+
+            with self._generation_slots:
+                filename, prompt, fallback = self.render(specs, duration_seconds, seed)
+            if fallback:
+                os.remove(filename)
+                raise RuntimeError(prompt)
+
+            target_name = _safe_name(task["id"]) + os.path.splitext(filename)[1]
+            os.replace(filename, os.path.join(self.output_dir, target_name))
+        except Exception as e:
+            self._record_failure(task, str(e), time.perf_counter() - start)
+            return
+
+        seconds = time.perf_counter() - start
+        self.manifest.record({
+            "id": task["id"],
+            "status": "done",
+            "file": target_name,
+            "prompt": prompt,
+            "specs": specs,
+            "duration": duration_seconds,
+            "seed": seed,
+            "seconds": round(seconds, 2),
+        })
+        with self._count_lock:
+            self.done += 1
+            self.audio_seconds += duration_seconds
+        print(f"完成 {task['id']} -> {target_name}（{seconds:.1f} 秒）")
+
+    def _record_failure(self, task, error, seconds):
+        self.manifest.record({"id": task["id"], "status": "failed", "error": error, "seconds": round(seconds, 2)})
+        with self._count_lock:
+            self.failed += 1
+        print(f"失败 {task['id']}: {error}")
+
+    def stats(self, elapsed):
+        return {
+            "done": self.done,
+            "failed": self.failed,
+            "skipped": self.skipped,
+            "elapsed_seconds": elapsed,
+            "tracks_per_hour": self.done / elapsed * 3600 if elapsed else 0.0,
+            "audio_seconds_per_second": self.audio_seconds / elapsed if elapsed else 0.0,
+        }
+
+
+def main():
+    from music_generator import MusicGenerator
+    from zhipu_client import ZhipuClient
+
+    parser = argparse.ArgumentParser(description="从 JSONL 文件批量渲染背景音乐，可断点续跑")
+    parser.add_argument("input", help="任务文件（JSONL）")
+    parser.add_argument("--output-dir", default="renders", help="音频和清单的输出目录")
+    parser.add_argument("--manifest", default=None, help=f"结果清单路径，默认 <输出目录>/{MANIFEST_NAME}")
+    parser.add_argument("--duration", type=int, default=20, help="任务未指定时长时使用的时长（秒）")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="任务未指定种子时使用的种子；固定种子的任务逐条推理，不与其他任务合并成批")
+    parser.add_argument("--analysis-concurrency", type=int, default=8, help="同时进行的需求分析数")
+    parser.add_argument("--workers", default="0",
+                        help="多进程任务池的工作进程数，auto 按核心数；0 表示在本进程内批量推理")
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    incoming_dir = os.path.join(args.output_dir, INCOMING_DIR_NAME)
+    manifest = Manifest(args.manifest or os.path.join(args.output_dir, MANIFEST_NAME), args.output_dir)
+    if manifest.completed:
+        print(f"清单中已有 {len(manifest.completed)} 个完成的任务，将跳过")
+
+    # 上次中断时留在暂存目录里的文件不会再被认领，开工前清掉
+    generator = MusicGenerator(output_dir=incoming_dir)
+    removed = generator.cleanup_temp_files(max_age_seconds=0)
+    if removed:
+        print(f"已清理暂存目录中 {removed} 个中断遗留的文件")
+
+    manager = None
+    if args.workers != "0":
+        from job_queue import JobManager
+
+        manager = JobManager(num_workers=None if args.workers == "auto" else int(args.workers),
+                             output_dir=incoming_dir)
+
+        def render(specs, duration_seconds, seed):
+            job_id = manager.submit(specs, duration_seconds, seed=seed)
+            filename, prompt = manager.result(job_id)
+            return filename, prompt, manager.status(job_id)["fallback"]
+
+        generation_concurrency = manager.num_workers * 2
+    else:
+        # 模型加载与最初几条需求分析同时进行
+        generator.start_background_load()
+
+        def render(specs, duration_seconds, seed):
+            return generator.generate_music(specs, duration_seconds, seed=seed, report_fallback=True)
+
+        generation_concurrency = generator.scheduler.max_batch_size
+
+    renderer = BatchRenderer(
+        ZhipuClient().analyze_music_request, render, args.output_dir, manifest,
+        duration_seconds=args.duration, seed=args.seed,
+        analysis_concurrency=args.analysis_concurrency, generation_concurrency=generation_concurrency,
+    )
+    try:
+        stats = renderer.run(read_tasks(args.input))
+    finally:
+        if manager is not None:
+            manager.shutdown()
+    print(f"批量渲染结束：完成 {stats['done']}，失败 {stats['failed']}，跳过 {stats['skipped']}，"
+          f"用时 {stats['elapsed_seconds']:.0f} 秒，{stats['tracks_per_hour']:.0f} 首/小时")
+
+
+if __name__ == "__main__":
+    main()
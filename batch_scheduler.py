@@ -0,0 +1,118 @@
+import os
+import time
+import queue
+import threading
+from concurrent.futures import Future
+
+
+class _Request:
+    def __init__(self, prompt, max_new_tokens, temperature, seed):
+        self.prompt = prompt
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.seed = seed
+        self.future = Future()
+
+    @property
+    def group_key(self):
+        # 只有生成参数相同的请求才能放进同一批
+        return (self.max_new_tokens, self.temperature, self.seed)
+
+
+class BatchScheduler:
+    """跨会话的微批调度器：在短时间窗口内收集请求，按参数分组后批量推理
+
+    批内各条的采样结果与同批的其他请求有关，因此固定种子的请求逐条推理，
+    保证同一种子总是得到同一结果；未指定种子的请求照常合并成批。
+    """
+
+    def __init__(self, run_batch, max_batch_size=None, max_wait_ms=None):
+        if max_batch_size is None:
+            max_batch_size = int(os.getenv("MUSIC_MAX_BATCH_SIZE", "4"))
+        if max_wait_ms is None:
+            max_wait_ms = int(os.getenv("MUSIC_BATCH_WAIT_MS", "50"))
+        self.run_batch = run_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000.0
+        self.batches_run = 0
+        self.requests_served = 0
+        self._queue = queue.Queue()
+        # 已从队列取出、尚未开始推理的请求数
+        self._collected = 0
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, prompt, max_new_tokens, temperature=1.0, seed=None):
+        """提交一个生成请求，返回Future，结果为单条音频字典"""
+        self._ensure_worker()
+        request = _Request(prompt, max_new_tokens, temperature, seed)
+        self._queue.put(request)
+        return request.future
+
+    def generate(self, prompt, max_new_tokens, temperature=1.0, seed=None):
+        """同步接口：提交并等待结果"""
+        return self.submit(prompt, max_new_tokens, temperature, seed).result()
+
+    def _ensure_worker(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._worker, name="musicgen-batcher", daemon=True
+                )
+                self._thread.start()
+
+    def _collect(self):
+        """阻塞等待第一个请求，然后在时间窗口内继续收集"""
+        pending = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(pending) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                pending.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return pending
+
+    def _worker(self):
+        while True:
+            pending = self._collect()
+            with self._lock:
+                self._collected = len(pending)
+
+            groups = {}
+            for request in pending:
+                groups.setdefault(request.group_key, []).append(request)
+
+            for (max_new_tokens, temperature, seed), requests in groups.items():
+                batches = [requests] if seed is None else [[request] for request in requests]
+                for batch in batches:
+                    with self._lock:
+                        self._collected -= len(batch)
+                    self._run_group(batch, max_new_tokens, temperature, seed)
+
+    def _run_group(self, requests, max_new_tokens, temperature, seed):
+        prompts = [request.prompt for request in requests]
+        try:
+            results = self.run_batch(prompts, max_new_tokens, temperature, seed)
+            if len(results) != len(requests):
+                raise RuntimeError(f"批量推理返回 {len(results)} 条结果，期望 {len(requests)} 条")
+        except Exception as e:
+            for request in requests:
+                request.future.set_exception(e)
+            return
+
+        self.batches_run += 1
+        self.requests_served += len(requests)
+        for request, result in zip(requests, results):
+            request.future.set_result(result)
+
+    def stats(self):
+        """返回批处理统计"""
+        return {
+            "batches_run": self.batches_run,
+            "requests_served": self.requests_served,
+            "avg_batch_size": self.requests_served / self.batches_run if self.batches_run else 0.0,
+            "queued": self._queue.qsize() + self._collected,
+        }
@@ -0,0 +1,50 @@
+"""MusicGen 批量推理吞吐基准（CPU）
+
+用法：python -m benchmarks.bench_batching --batch-sizes 1 2 4 8 --tokens 256
+"""
+import argparse
+import time
+
+from music_generator import MusicGenerator
+
+PROMPTS = [
+    "Happy and upbeat pop music with piano melody, drums and bass, cheerful atmosphere, fast tempo",
+    "Sad and emotional classical music with piano and violin, melancholic atmosphere, slow tempo",
+    "Epic and intense battle music with orchestra, powerful drums and choir, heroic atmosphere, fast tempo",
+    "Traditional Chinese music with guzheng, flute and erhu, elegant and cultural atmosphere, medium tempo",
+]
+
+
+def run(batch_sizes, max_new_tokens, repeats):
+    generator = MusicGenerator()
+    generator.load_model()
+
+    # 预热一次，排除首次调用的初始化开销
+    generator._run_batch(PROMPTS[:1], 16, generator.temperature, 0)
+
+    print(f"{'batch':>6} {'seconds':>9} {'clips/s':>9} {'audio_s/s':>10}")
+    for batch_size in batch_sizes:
+        prompts = [PROMPTS[i % len(PROMPTS)] for i in range(batch_size)]
+        start = time.perf_counter()
+        audio_seconds = 0.0
+        for i in range(repeats):
+            results = generator._run_batch(prompts, max_new_tokens, generator.temperature, i)
+            audio_seconds += sum(
+                r["audio"].shape[-1] / r["sampling_rate"] for r in results
+            )
+        elapsed = time.perf_counter() - start
+        clips = batch_size * repeats
+        print(f"{batch_size:>6} {elapsed:>9.2f} {clips / elapsed:>9.3f} {audio_seconds / elapsed:>10.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MusicGen 批量推理吞吐基准")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--tokens", type=int, default=256, help="每条生成的token数（50 tokens ≈ 1秒）")
+    parser.add_argument("--repeats", type=int, default=2)
+    args = parser.parse_args()
+    run(args.batch_sizes, args.tokens, args.repeats)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""CPU推理模式基准：对比各模式的 tokens/秒、实时率(RTF) 和峰值内存
+
+每种模式在独立子进程中运行，保证峰值内存互不干扰。
+用法：python -m benchmarks.bench_inference_modes --modes fp32 bf16 int8 --compile --threads 4
+"""
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+
+PROMPT = "Relaxing beach walk music with gentle piano melody, soft string accompaniment, slow tempo"
+
+
+def run_child(mode, use_compile, threads, tokens, repeats):
+    from music_generator import MusicGenerator
+
+    generator = MusicGenerator(inference_mode=mode, use_compile=use_compile, num_threads=threads)
+    generator.load_model()
+    generator.warm_up()
+
+    elapsed = 0.0
+    audio_seconds = 0.0
+    for i in range(repeats):
+        start = time.perf_counter()
+        result = generator._run_batch([PROMPT], tokens, generator.temperature, i)[0]
+        elapsed += time.perf_counter() - start
+        audio_seconds += result["audio"].shape[-1] / result["sampling_rate"]
+
+    # Linux 下 ru_maxrss 单位为KB
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(json.dumps({
+        "mode": mode + ("+compile" if use_compile else ""),
+        "tokens_per_second": tokens * repeats / elapsed,
+        "real_time_factor": elapsed / audio_seconds,
+        "peak_rss_mb": peak_rss_mb,
+        "load_seconds": generator.timings.get("load_seconds"),
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CPU推理模式基准")
+    parser.add_argument("--modes", nargs="+", default=["fp32", "bf16", "int8"])
+    parser.add_argument("--compile", action="store_true", help="额外测试每种模式开启 torch.compile")
+    parser.add_argument("--threads", type=int, default=None, help="intra-op 线程数")
+    parser.add_argument("--tokens", type=int, default=250, help="每次生成的token数（50 tokens ≈ 1秒）")
+    parser.add_argument("--repeats", type=int, default=2)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--use-compile", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.modes[0], args.use_compile, args.threads, args.tokens, args.repeats)
+        return
+
+    variants = [(mode, False) for mode in args.modes]
+    if args.compile:
+        variants += [(mode, True) for mode in args.modes]
+
+    rows = []
+    for mode, use_compile in variants:
+        cmd = [sys.executable, "-m", "benchmarks.bench_inference_modes", "--child",
+               "--modes", mode, "--tokens", str(args.tokens), "--repeats", str(args.repeats)]
+        if use_compile:
+            cmd.append("--use-compile")
+        if args.threads:
+            cmd += ["--threads", str(args.threads)]
+        proc = subprocess.run(cmd, capture_output=True, text=True)
+        lines = [line for line in proc.stdout.splitlines() if line.startswith("{")]
+        if proc.returncode != 0 or not lines:
+            print(f"{mode} 运行失败:\n{proc.stderr[-2000:]}")
+            continue
+        rows.append(json.loads(lines[-1]))
+
+    print(f"{'mode':<14} {'tokens/s':>9} {'RTF':>7} {'peak RSS(MB)':>13}")
+    for row in rows:
+        print(f"{row['mode']:<14} {row['tokens_per_second']:>9.1f} "
+              f"{row['real_time_factor']:>7.2f} {row['peak_rss_mb']:>13.0f}")
+
+
+if __name__ == "__main__":
+    main()
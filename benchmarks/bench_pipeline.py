@@ -0,0 +1,233 @@
+"""端到端分阶段延迟基准
+
+驱动真实的 ZhipuClient.analyze_music_request → MusicGenerator._build_music_prompt →
+generate_music（排队 + 推理 + WAV写出）路径：
+- 大模型调用指向本地替身服务（benchmarks.llm_standin，可配置延迟）
+- self.pipe 被替换为确定性的桩模型（可配置每token耗时），也可用 --real-model 加载真实模型
+
+输出各阶段 p50/p95/p99、N个并发调用方下的吞吐和峰值内存，结果写为JSON便于版本间对比。
+用法：python -m benchmarks.bench_pipeline --requests 50 --concurrency 1 4 --output pipeline_bench.json
+"""
+import argparse
+import hashlib
+import json
+import platform
+import resource
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import types
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from audio_cache import AudioCache
+from benchmarks.llm_standin import start_standin
+from llm_cache import LLMCache
+from llm_transport import LLMTransport
+from music_generator import MusicGenerator, TOKENS_PER_SECOND
+from zhipu_client import ZhipuClient
+
+USER_INPUTS = [
+    "电子游戏背景音乐，欢快活泼，有电子合成器和鼓点",
+    "悲伤的钢琴曲，缓慢的节奏，表达失落的情感",
+    "中国古风音乐，使用古筝和笛子，优雅传统",
+    "激昂的战斗配乐，强烈的节奏，使用管弦乐和打击乐",
+]
+
+
+class StubProcessor:
+    """确定性分词桩：按字符编码生成token"""
+    tokenizer = types.SimpleNamespace(pad_token_id=0)
+
+    def __call__(self, text=None, audio=None, sampling_rate=None, padding=True, return_tensors="pt"):
+        import torch
+        from transformers import BatchEncoding
+
+        ids = [[(ord(ch) % 250) + 2 for ch in t][:64] + [1] for t in text]
+        max_len = max(len(i) for i in ids)
+        return BatchEncoding({
+            "input_ids": torch.tensor([i + [0] * (max_len - len(i)) for i in ids]),
+            "attention_mask": torch.tensor([[1] * len(i) + [0] * (max_len - len(i)) for i in ids]),
+        })
+
+
+class StubModel:
+    """确定性MusicGen桩：输出由提示词决定的正弦波，可按token模拟计算耗时"""
+    device = "cpu"
+    sampling_rate = 32000
+
+    def __init__(self, ms_per_token):
+        self.ms_per_token = ms_per_token
+        self.config = types.SimpleNamespace(
+            audio_encoder=types.SimpleNamespace(sampling_rate=self.sampling_rate)
+        )
+        self.generation_config = types.SimpleNamespace(guidance_scale=None)
+
+    def text_encoder(self, input_ids, attention_mask):
+        import torch
+        return types.SimpleNamespace(last_hidden_state=torch.zeros(*input_ids.shape, 8))
+
+    def generate(self, input_ids, max_new_tokens, **kwargs):
+        import torch
+        time.sleep(self.ms_per_token * max_new_tokens / 1000.0)
+        samples = max_new_tokens * (self.sampling_rate // TOKENS_PER_SECOND)
+        t = torch.arange(samples, dtype=torch.float32) / self.sampling_rate
+        waves = []
+        for row in input_ids:
+            freq = 220 + int(hashlib.md5(row.numpy().tobytes()).hexdigest()[:4], 16) % 440
+            waves.append(0.3 * torch.sin(2 * np.pi * freq * t))
+        return torch.stack(waves)[:, None, :]
+
+
+def build_generator(real_model, ms_per_token, cache_dir):
+    generator = MusicGenerator(audio_cache=AudioCache(cache_dir))
+    if real_model:
+        generator.load_model()
+        generator.warm_up()
+    else:
+        generator.pipe = types.SimpleNamespace(model=StubModel(ms_per_token))
+        generator.processor = StubProcessor()
+        generator.model_loaded = True
+
+    # 包装批量推理，单独统计推理耗时
+    inference_times = {}
+    run_batch = generator._run_batch
+
+    def timed_run_batch(prompts, *args):
+        start = time.perf_counter()
+        results = run_batch(prompts, *args)
+        elapsed = time.perf_counter() - start
+        for prompt in prompts:
+            inference_times[prompt] = elapsed
+        return results
+
+    generator._run_batch = timed_run_batch
+    generator.scheduler.run_batch = timed_run_batch
+    return generator, inference_times
+
+
+def run_one(client, generator, inference_times, index, duration, seeded=False):
+    """执行一次完整请求，返回各阶段耗时（秒）"""
+    timings = {}
+    start = time.perf_counter()
+    # 每次输入不同，避免命中需求分析缓存
+    specs = client.analyze_music_request(f"{USER_INPUTS[index % len(USER_INPUTS)]} #{index}")
+    timings["llm_analyze"] = time.perf_counter() - start
+
+    stage = time.perf_counter()
+    prompt = generator._build_music_prompt(specs)
+    timings["build_prompt"] = time.perf_counter() - stage
+
+    # 每次提示词不同，避免命中音频缓存
+    specs["music_prompt"] = f"{prompt} (take {index})"
+    stage = time.perf_counter()
+    # 与界面一样不固定种子时，并发请求才会被调度器合并成批；固定种子的请求逐条推理
+    generator.generate_music(specs, duration, seed=index if seeded else None)
+    generate_seconds = time.perf_counter() - stage
+    inference = inference_times.pop(specs["music_prompt"], 0.0)
+    timings["inference"] = inference
+    timings["queue_wait_and_write"] = generate_seconds - inference
+    timings["total"] = time.perf_counter() - start
+    return timings
+
+
+def percentiles(values):
+    values = np.asarray(values)
+    return {
+        "p50_ms": float(np.percentile(values, 50) * 1000),
+        "p95_ms": float(np.percentile(values, 95) * 1000),
+        "p99_ms": float(np.percentile(values, 99) * 1000),
+        "mean_ms": float(values.mean() * 1000),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="端到端分阶段延迟基准")
+    parser.add_argument("--requests", type=int, default=40, help="每个并发级别的请求数")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--duration", type=int, default=5, help="每次生成的音乐时长（秒）")
+    parser.add_argument("--llm-latency-ms", type=float, default=300.0, help="替身服务的响应延迟")
+    parser.add_argument("--stub-ms-per-token", type=float, default=2.0, help="桩模型每token的模拟耗时")
+    parser.add_argument("--local-router", action="store_true", help="启用本地意图路由（示例输入将跳过大模型）")
+    parser.add_argument("--real-model", action="store_true", help="使用真实MusicGen模型")
+    parser.add_argument("--seeded", action="store_true", help="每个请求固定不同的种子（不会合并成批）")
+    parser.add_argument("--output", default="pipeline_bench.json", help="JSON结果输出路径")
+    args = parser.parse_args()
+
+    server, url = start_standin(args.llm_latency_ms / 1000.0)
+    client = ZhipuClient(cache=LLMCache(max_entries=1))
+    client.transport = LLMTransport("bench.secret", base_url=url, max_concurrency=max(args.concurrency))
+    client.mock_mode = False
+    if not args.local_router:
+        client.router = None
+
+    cache_dir = tempfile.mkdtemp(prefix="bench-audio-cache-")
+    output_dir = tempfile.mkdtemp(prefix="bench-audio-out-")
+    generator, inference_times = build_generator(args.real_model, args.stub_ms_per_token, cache_dir)
+    generator.output_dir = output_dir
+
+    # 预热一次，排除首次导入和初始化开销
+    run_one(client, generator, inference_times, -1, args.duration, args.seeded)
+
+    tracemalloc.start()
+    report = {
+        "revision": git_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "config": vars(args),
+        "runs": [],
+    }
+
+    index = 0
+    for concurrency in args.concurrency:
+        indices = list(range(index, index + args.requests))
+        index += args.requests
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            results = list(pool.map(
+                lambda i: run_one(client, generator, inference_times, i, args.duration, args.seeded), indices
+            ))
+        wall = time.perf_counter() - start
+
+        stages = {name: percentiles([r[name] for r in results]) for name in results[0]}
+        run = {
+            "concurrency": concurrency,
+            "requests": args.requests,
+            "wall_seconds": wall,
+            "throughput_rps": args.requests / wall,
+            "stages": stages,
+        }
+        report["runs"].append(run)
+
+        print(f"\n并发 {concurrency}: {args.requests} 个请求，用时 {wall:.2f} 秒，吞吐 {run['throughput_rps']:.2f} req/s")
+        print(f"{'stage':<24} {'p50(ms)':>9} {'p95(ms)':>9} {'p99(ms)':>9}")
+        for name, stat in stages.items():
+            print(f"{name:<24} {stat['p50_ms']:>9.1f} {stat['p95_ms']:>9.1f} {stat['p99_ms']:>9.1f}")
+
+    _, python_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    report["memory"] = {
+        "python_peak_mb": python_peak / 1024 / 1024,
+        # Linux 下 ru_maxrss 单位为KB
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+    print(f"\n峰值内存: Python {report['memory']['python_peak_mb']:.1f} MB, "
+          f"RSS {report['memory']['peak_rss_mb']:.1f} MB")
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"结果已写入 {args.output}")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""模型副本数 × 每副本线程数 扫描基准（CPU）
+
+每组配置启动 K 个绑核的工作进程，提交一批生成任务，统计就绪时间、任务延迟、吞吐，
+以及所有副本的常驻内存（RSS）和按共享比例分摊后的内存（PSS）。
+权重映射共享时 PSS 应远小于 K 倍的单副本占用。
+
+用法：python -m benchmarks.bench_replicas --replicas 1 2 4 --threads 1 2 4 --jobs 8 --duration 5
+"""
+import os
+import json
+import time
+import argparse
+import tempfile
+
+from job_queue import JobManager, _available_cores
+
+SPECS = {
+    "style": "电子",
+    "mood": "欢快",
+    "instruments": ["合成器", "鼓"],
+    "tempo": "快速",
+    "duration": 5,
+    "music_prompt": "Happy and upbeat electronic music with synthesizer and drums, fast tempo",
+}
+
+
+def _memory_kb(pid):
+    """读取进程的 Rss/Pss（KB），进程不存在时返回 (0, 0)"""
+    values = {}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup", "r") as f:
+            for line in f:
+                parts = line.split()
+                if parts[0] in ("Rss:", "Pss:"):
+                    values[parts[0][:-1]] = int(parts[1])
+    except OSError:
+        return 0, 0
+    return values.get("Rss", 0), values.get("Pss", 0)
+
+
+def _percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def run_config(replicas, threads, jobs, duration, seed_base, ready_timeout):
+    start = time.perf_counter()
+    manager = JobManager(num_workers=replicas, threads_per_worker=threads)
+    try:
+        while manager.stats()["ready_workers"] < replicas:
+            if time.perf_counter() - start > ready_timeout:
+                raise TimeoutError(f"{replicas} 个副本未在 {ready_timeout} 秒内就绪")
+            time.sleep(0.2)
+        ready_seconds = time.perf_counter() - start
+
+        # 种子各不相同，避免命中音频缓存
+        submit_start = time.perf_counter()
+        job_ids = [manager.submit(SPECS, duration, seed=seed_base + i) for i in range(jobs)]
+        for job_id in job_ids:
+            manager.result(job_id)
+        wall = time.perf_counter() - submit_start
+
+        latencies = []
+        for job_id in job_ids:
+            job = manager.status(job_id)
+            latencies.append(job["finished_at"] - job["submitted_at"])
+        stats = manager.stats()
+        rss = pss = 0
+        for replica in stats["replicas"]:
+            replica_rss, replica_pss = _memory_kb(replica["pid"])
+            rss += replica_rss
+            pss += replica_pss
+        return {
+            "replicas": replicas,
+            "threads": threads,
+            "ready_seconds": round(ready_seconds, 2),
+            "p50_seconds": round(_percentile(latencies, 0.5), 2),
+            "p95_seconds": round(_percentile(latencies, 0.95), 2),
+            "jobs_per_minute": round(jobs / wall * 60, 2),
+            "audio_seconds_per_second": round(jobs * duration / wall, 3),
+            "rss_mb": round(rss / 1024, 1),
+            "pss_mb": round(pss / 1024, 1),
+            "completed_per_replica": [replica["completed"] for replica in stats["replicas"]],
+        }
+    finally:
+        manager.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="模型副本数 × 线程数扫描基准")
+    parser.add_argument("--replicas", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--jobs", type=int, default=8, help="每组配置提交的任务数")
+    parser.add_argument("--duration", type=int, default=5, help="每个任务的音频时长（秒）")
+    parser.add_argument("--ready-timeout", type=float, default=600)
+    parser.add_argument("--allow-oversubscribe", action="store_true", help="也测试副本数×线程数超过核心数的配置")
+    parser.add_argument("--output", default=None, help="结果写入的JSON文件")
+    args = parser.parse_args()
+
+    # 基准结果不写入正式的音频缓存，也不读取已有缓存
+    os.environ["MUSIC_CACHE_DIR"] = tempfile.mkdtemp(prefix="bench_replicas_cache_")
+    cores = len(_available_cores())
+    print(f"可用核心: {cores}")
+    print(f"{'K':>3} {'threads':>8} {'ready_s':>8} {'p50_s':>7} {'p95_s':>7} {'jobs/min':>9} "
+          f"{'audio_s/s':>10} {'RSS_MB':>8} {'PSS_MB':>8}")
+    results = []
+    for index, (replicas, threads) in enumerate(
+        (k, t) for k in args.replicas for t in args.threads
+    ):
+        if replicas * threads > cores and not args.allow_oversubscribe:
+            print(f"{replicas:>3} {threads:>8}  跳过（需要 {replicas * threads} 个核心）")
+            continue
+        result = run_config(replicas, threads, args.jobs, args.duration, index * 10000, args.ready_timeout)
+        results.append(result)
+        print(f"{replicas:>3} {threads:>8} {result['ready_seconds']:>8.1f} {result['p50_seconds']:>7.2f} "
+              f"{result['p95_seconds']:>7.2f} {result['jobs_per_minute']:>9.2f} "
+              f"{result['audio_seconds_per_second']:>10.3f} {result['rss_mb']:>8.1f} {result['pss_mb']:>8.1f}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"cores": cores, "jobs": args.jobs, "duration": args.duration, "results": results},
+                      f, ensure_ascii=False, indent=2)
+        print(f"结果已写入 {args.output}")
+
+
+if __name__ == "__main__":
+    main()
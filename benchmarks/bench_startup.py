@@ -0,0 +1,42 @@
+"""启动耗时基准：可交互时间（模块导入 + 对象创建）与首次生成时间
+
+用法：python -m benchmarks.bench_startup --duration 5
+"""
+import argparse
+import time
+
+START = time.perf_counter()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="应用启动耗时基准")
+    parser.add_argument("--duration", type=int, default=5, help="首次生成的音乐时长（秒）")
+    args = parser.parse_args()
+
+    from music_generator import MusicGenerator, STATUS_READY, STATUS_FAILED
+
+    generator = MusicGenerator()
+    generator.start_background_load()
+    time_to_interactive = time.perf_counter() - START
+    print(f"可交互时间（导入 + 创建生成器）: {time_to_interactive:.2f} 秒")
+
+    # 等待后台加载与预热完成
+    while generator.status not in (STATUS_READY, STATUS_FAILED):
+        time.sleep(0.05)
+    time_to_ready = time.perf_counter() - START
+    print(f"模型就绪时间: {time_to_ready:.2f} 秒 "
+          f"(加载 {generator.timings.get('load_seconds', 0):.2f} 秒, "
+          f"预热 {generator.timings.get('warmup_seconds', 0):.2f} 秒)")
+    if generator.status == STATUS_FAILED:
+        print(f"模型加载失败: {generator.load_error}")
+        return
+
+    # 使用唯一提示词，避免命中音频缓存
+    specs = {"music_prompt": f"calm piano background music, startup benchmark {time.time()}"}
+    generator.generate_music(specs, args.duration)
+    time_to_first_generation = time.perf_counter() - START
+    print(f"首次生成完成时间: {time_to_first_generation:.2f} 秒")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""本地智谱AI替身服务
+
+按 v3 model-api 协议（POST <base>/<model>/invoke 或 sse-invoke 流式）返回固定的分析结果，可模拟慢响应和失败响应，
+用于在不访问真实服务的情况下验证 LLMTransport 的超时、重试和熔断行为。
+
+用法：python -m benchmarks.llm_standin --port 8765 --latency-ms 3000 --failure-rate 0.5
+然后设置 ZHIPUAI_BASE_URL=http://127.0.0.1:8765 启动应用。
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FAKE_LLM_REPLY = {
+    "music_prompt": "Relaxing background music with gentle piano and soft strings, slow tempo",
+    "style": "轻音乐",
+    "mood": "轻松",
+    "instruments": ["钢琴", "弦乐"],
+    "tempo": "慢速",
+    "duration": 20,
+}
+
+
+class _StandinHandler(BaseHTTPRequestHandler):
+    latency = 0.0
+    chunk_latency = 0.0
+    failure_rate = 0.0
+    failure_status = 503
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.request_count += 1
+        time.sleep(self.latency)
+        if random.random() < self.failure_rate:
+            self.send_error(self.failure_status)
+            return
+        content = "分析结果如下：\n" + json.dumps(FAKE_LLM_REPLY, ensure_ascii=False)
+        if self.path.endswith("/sse-invoke"):
+            self._stream(content)
+            return
+        body = json.dumps({"code": 200, "data": {"choices": [{"content": content}]}}).encode("utf-8")
+        try:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端已超时放弃
+            pass
+
+    def _stream(self, content, chunk_chars=8):
+        # 与上游一致：回复拆成多个 add 事件，换行拆成多条 data 行，最后发送 finish
+        try:
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.end_headers()
+            for start in range(0, len(content), chunk_chars):
+                piece = content[start:start + chunk_chars]
+                lines = "".join(f"data: {line}\n" for line in piece.split("\n"))
+                self.wfile.write(f"event: add\n{lines}\n".encode("utf-8"))
+                self.wfile.flush()
+                time.sleep(self.chunk_latency)
+            self.wfile.write(b'event: finish\ndata: \nmeta: {"usage": {}}\n\n')
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+def start_standin(latency=0.0, failure_rate=0.0, failure_status=503, port=0, chunk_latency=0.0):
+    """在后台线程启动替身服务，返回 (server, base_url)；server.request_count 为收到的请求数
+
+    latency 为首字节前的延迟，chunk_latency 为流式响应中每个片段之间的间隔。
+    """
+    handler = type("StandinHandler", (_StandinHandler,), {
+        "latency": latency,
+        "chunk_latency": chunk_latency,
+        "failure_rate": failure_rate,
+        "failure_status": failure_status,
+    })
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.request_count = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地智谱AI替身服务")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="每个请求的响应延迟")
+    parser.add_argument("--chunk-latency-ms", type=float, default=0.0, help="流式响应片段之间的间隔")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="返回错误状态码的比例")
+    parser.add_argument("--failure-status", type=int, default=503)
+    args = parser.parse_args()
+
+    server, url = start_standin(args.latency_ms / 1000.0, args.failure_rate, args.failure_status, args.port,
+                                args.chunk_latency_ms / 1000.0)
+    print(f"替身服务已启动: {url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
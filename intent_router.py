@@ -0,0 +1,219 @@
+import os
+import json
+from collections import deque
+from llm_cache import normalize_text
+import metrics
+
+DEFAULT_TAXONOMY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "intent_taxonomy.json")
+
+# 多值类别（乐器）可同时命中多个标签，其余类别只取一个
+CATEGORIES = ("styles", "moods", "instruments", "tempos")
+
+# 置信度权重：风格和情绪决定整体方向，乐器和节奏是补充
+WEIGHTS = {"styles": 0.35, "moods": 0.35, "instruments": 0.15, "tempos": 0.05}
+COVERAGE_WEIGHT = 0.1
+# 同一类别中次高分达到最高分的该比例即视为冲突（如同时出现“欢快”和“悲伤”）
+CONFLICT_RATIO = 0.8
+CONFLICT_PENALTY = 0.3
+
+
+class _AhoCorasick:
+    """多模式关键词匹配自动机，一次扫描找出文本中所有关键词"""
+
+    def __init__(self, patterns):
+        # patterns: {关键词: [载荷, ...]}
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [[]]
+        for word, payloads in patterns.items():
+            node = 0
+            for ch in word:
+                if ch not in self._goto[node]:
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append([])
+                    self._goto[node][ch] = len(self._goto) - 1
+                node = self._goto[node][ch]
+            self._output[node].extend((word, payload) for payload in payloads)
+
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, child in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                target = self._goto[fail].get(ch, 0)
+                self._fail[child] = target if target != child else 0
+                self._output[child] = self._output[child] + self._output[self._fail[child]]
+
+    def search(self, text):
+        """返回 [(结束位置, 关键词, 载荷), ...]"""
+        matches = []
+        node = 0
+        for i, ch in enumerate(text):
+            while node and ch not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(ch, 0)
+            for word, payload in self._output[node]:
+                matches.append((i + 1, word, payload))
+        return matches
+
+
+def _is_word_char(ch):
+    return ch.isascii() and ch.isalnum()
+
+
+def _ends_with_word(text, word):
+    """text 是否以 word 结尾；英文词要求整词"""
+    if not text.endswith(word):
+        return False
+    before = len(text) - len(word) - 1
+    return not (_is_word_char(word[0]) and before >= 0 and _is_word_char(text[before]))
+
+
+class IntentRouter:
+    """本地意图路由：按关键词词表识别风格、情绪、乐器和节奏并打分
+
+    置信度达到阈值的输入直接在本地生成音乐需求，其余交给大模型分析。
+    """
+
+    def __init__(self, taxonomy_path=None, threshold=None):
+        self.taxonomy_path = taxonomy_path or os.getenv("MUSIC_TAXONOMY_FILE", DEFAULT_TAXONOMY_FILE)
+        if threshold is None:
+            threshold = float(os.getenv("MUSIC_ROUTER_THRESHOLD", "0.75"))
+        self.threshold = threshold
+        self.local_routes = 0
+        self.remote_routes = 0
+        with open(self.taxonomy_path, "r", encoding="utf-8") as f:
+            self.taxonomy = json.load(f)
+
+        patterns = {}
+        for category in CATEGORIES:
+            for label, entry in self.taxonomy.get(category, {}).items():
+                for keyword in entry["keywords"] + [label]:
+                    patterns.setdefault(normalize_text(keyword), []).append((category, label))
+        for keyword in self.taxonomy.get("ambiguous", []):
+            patterns.setdefault(normalize_text(keyword), []).append(("ambiguous", None))
+        patterns.pop("", None)
+        self._automaton = _AhoCorasick(patterns)
+        # 关键词前的否定词（可隔着“太”“那么”等程度词），如“一点也不快乐”“不那么激昂”
+        self._negations = [normalize_text(word) for word in self.taxonomy.get("negations", [])]
+        self._negation_modifiers = sorted(
+            (normalize_text(word) for word in self.taxonomy.get("negation_modifiers", [])), key=len, reverse=True
+        )
+        self._negation_exceptions = [normalize_text(word) for word in self.taxonomy.get("negation_exceptions", [])]
+
+    def _is_negated(self, prefix):
+        """关键词之前的文本是否以否定词结尾"""
+        while True:
+            prefix = prefix.rstrip()
+            for modifier in self._negation_modifiers:
+                if modifier and _ends_with_word(prefix, modifier):
+                    prefix = prefix[:-len(modifier)]
+                    break
+            else:
+                break
+        if any(prefix.endswith(word) for word in self._negation_exceptions if word):
+            return False
+        return any(word and _ends_with_word(prefix, word) for word in self._negations)
+
+    def classify(self, text):
+        """识别一条输入，返回 {"specs", "confidence", "matches"}；没有任何命中时 specs 为None"""
+        normalized = normalize_text(text)
+        scores = {category: {} for category in CATEGORIES}
+        covered = set()
+        ambiguous = False
+        accepted = []
+        # 长关键词优先，被同类别更长关键词包含的命中（如“管弦乐”中的“弦乐”）不再计分
+        hits = sorted(self._automaton.search(normalized), key=lambda hit: -len(hit[1]))
+        for end, word, (category, label) in hits:
+            start = end - len(word)
+            # 英文关键词要求整词匹配，避免 "fast" 命中 "breakfast"
+            if _is_word_char(word[0]) and start > 0 and _is_word_char(normalized[start - 1]):
+                continue
+            if _is_word_char(word[-1]) and end < len(normalized) and _is_word_char(normalized[end]):
+                continue
+            if category == "ambiguous" or self._is_negated(normalized[:start]):
+                ambiguous = True
+                continue
+            if any(c == category and s <= start and end <= e for c, s, e in accepted):
+                continue
+            accepted.append((category, start, end))
+            scores[category][label] = scores[category].get(label, 0) + len(word)
+            covered.update(range(start, end))
+
+        matches = {category: sorted(labels, key=labels.get, reverse=True) for category, labels in scores.items()}
+        text_chars = sum(1 for ch in normalized if not ch.isspace())
+        coverage = len(covered) / text_chars if text_chars else 0.0
+
+        confidence = 0.0
+        for category, labels in scores.items():
+            if not labels:
+                continue
+            confidence += WEIGHTS[category]
+            if category != "instruments" and len(labels) > 1:
+                ranked = sorted(labels.values(), reverse=True)
+                if ranked[1] >= ranked[0] * CONFLICT_RATIO:
+                    confidence -= CONFLICT_PENALTY
+        confidence += COVERAGE_WEIGHT * min(1.0, coverage * 2)
+        # 含否定或转折的描述、被否定的关键词容易误判，交给大模型
+        if ambiguous:
+            confidence = 0.0
+        confidence = max(0.0, min(1.0, confidence))
+
+        specs = self._build_specs(matches) if any(matches.values()) else None
+        return {"specs": specs, "confidence": confidence, "matches": matches}
+
+    def classify_batch(self, texts):
+        """批量识别，返回与输入顺序一致的结果列表"""
+        return [self.classify(text) for text in texts]
+
+    def route(self, text):
+        """置信度足够时返回本地生成的音乐需求，否则返回None"""
+        result = self.classify(text)
+        if result["specs"] is None or result["confidence"] < self.threshold:
+            self.remote_routes += 1
+            metrics.inc("intent_route_total", route="remote")
+            return None
+        self.local_routes += 1
+        metrics.inc("intent_route_total", route="local")
+        return result["specs"]
+
+    def stats(self):
+        """返回路由概况"""
+        total = self.local_routes + self.remote_routes
+        return {
+            "local": self.local_routes,
+            "remote": self.remote_routes,
+            "local_rate": self.local_routes / total if total else 0.0,
+        }
+
+    def _build_specs(self, matches):
+        """按命中的标签组装与大模型输出格式一致的音乐需求"""
+        styles = self.taxonomy["styles"]
+        style = matches["styles"][0] if matches["styles"] else next(iter(styles))
+        style_entry = styles[style]
+        mood = matches["moods"][0] if matches["moods"] else next(iter(self.taxonomy["moods"]))
+        instruments = matches["instruments"][:3] or style_entry["instruments"]
+        tempo = matches["tempos"][0] if matches["tempos"] else style_entry["tempo"]
+
+        instrument_prompts = [self.taxonomy["instruments"][name]["prompt"] for name in instruments]
+        if len(instrument_prompts) > 1:
+            instrument_text = ", ".join(instrument_prompts[:-1]) + " and " + instrument_prompts[-1]
+        else:
+            instrument_text = instrument_prompts[0]
+        mood_prompt = self.taxonomy["moods"][mood]["prompt"]
+        music_prompt = (
+            f"{mood_prompt[0].upper()}{mood_prompt[1:]} {style_entry['prompt']} music with "
+            f"{instrument_text}, {self.taxonomy['tempos'][tempo]['prompt']}"
+        )
+        return {
+            "style": style,
+            "mood": mood,
+            "instruments": list(instruments),
+            "tempo": tempo,
+            "duration": 20,
+            "music_prompt": music_prompt,
+        }
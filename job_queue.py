@@ -0,0 +1,354 @@
+import os
+import time
+import uuid
+import queue
+import threading
+import multiprocessing
+
+# 任务状态
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+# 超过单窗口时长的任务分段生成，以便汇报进度和响应取消
+PROGRESS_BLOCK_SECONDS = 20
+
+# 已结束任务的状态保留时长
+FINISHED_JOB_TTL = 3600
+
+# 工作进程退出后的重启退避（秒，逐次翻倍）；连续失败这么多次仍未就绪则不再重启
+WORKER_RESTART_BACKOFF = 1.0
+WORKER_RESTART_BACKOFF_MAX = 60.0
+MAX_WORKER_START_FAILURES = 5
+
+# 巡检工作进程存活的间隔
+MONITOR_INTERVAL = 1.0
+
+
+def _plan_core_sets(num_workers, threads_per_worker):
+    """为每个工作进程划分互不重叠的CPU核心；核心不够时循环复用并提示"""
+    if not hasattr(os, "sched_getaffinity"):
+        return [None] * num_workers
+    cores = sorted(os.sched_getaffinity(0))
+    if num_workers * threads_per_worker > len(cores):
+        print(f"警告: {num_workers} 个工作进程 × {threads_per_worker} 线程超过可用核心数 {len(cores)}，核心将被共用")
+    return [
+        sorted({cores[(worker_id * threads_per_worker + i) % len(cores)] for i in range(threads_per_worker)})
+        for worker_id in range(num_workers)
+    ]
+
+
+def _available_cores():
+    if hasattr(os, "sched_getaffinity"):
+        return os.sched_getaffinity(0)
+    return range(os.cpu_count() or 1)
+
+
+def _worker_main(worker_id, tasks, events, cancelled, threads_per_worker, output_dir, cores=None):
+    """工作进程入口：绑定核心，加载一次模型，然后循环处理任务"""
+    if cores:
+        # 先绑核再导入torch，让线程池按绑定后的核心初始化
+        os.sched_setaffinity(0, set(cores))
+    os.environ["OMP_NUM_THREADS"] = str(threads_per_worker)
+    from music_generator import MusicGenerator
+
+    # 常驻副本不做空闲卸载：卸载会丢掉共享映射的权重，下一个任务要整个重新加载
+    generator = MusicGenerator(num_threads=threads_per_worker, output_dir=output_dir, idle_unload_seconds=0)
+    generator.load_model()
+    generator.warm_up()
+    events.put(("ready", worker_id, os.getpid()))
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        job_id, music_specs, duration_seconds, seed = task
+        if job_id in cancelled:
+            continue
+
+        events.put(("started", job_id, worker_id))
+        try:
+            fallback = False
+            if duration_seconds <= PROGRESS_BLOCK_SECONDS * 1.5:
+                filename, prompt, fallback = generator.generate_music(
+                    music_specs, duration_seconds, seed=seed, report_fallback=True
+                )
+            else:
+                filename, prompt = None, None
+                generated_seconds = 0.0
+                for part in generator.stream_music(
+                    music_specs, duration_seconds,
+                    block_seconds=PROGRESS_BLOCK_SECONDS, overlap_seconds=4, seed=seed
+                ):
+                    filename, prompt = part["filename"], part["prompt"]
+                    generated_seconds += len(part["audio"]) / part["sampling_rate"]
+                    events.put(("progress", job_id, min(generated_seconds / duration_seconds, 1.0)))
+                    if job_id in cancelled:
+                        break
+                if job_id in cancelled:
+                    if filename is not None:
+                        # 中途停下的半成品不再需要
+                        try:
+                            os.remove(filename)
+                        except OSError:
+                            pass
+                    events.put(("cancelled", job_id))
+                    continue
+            events.put(("done", job_id, filename, prompt, fallback))
+        except Exception as e:
+            events.put(("failed", job_id, str(e)))
+
+
+class JobManager:
+    """进程外音乐生成任务池：任务排队、状态查询、取消，结果通过文件交付
+
+    每个工作进程是一个模型副本，绑定在独立的核心上并使用固定线程数；
+    模型权重映射自同一个 safetensors 文件，多个副本共享物理内存。
+    所有副本从同一个任务队列取任务，空闲副本先取到，相当于总是交给负载最低的副本。
+
+    取消从不终止工作进程（终止时可能正在写共享队列）：分段生成的任务在分段之间停下，
+    单窗口任务照常跑完，结果直接丢弃。
+    工作进程退出后按退避间隔重启，连续启动失败过多的不再重启；全部放弃后排队中的任务直接失败。
+    """
+
+    def __init__(self, num_workers=None, threads_per_worker=None, output_dir=None, pin_cores=None):
+        if threads_per_worker is None:
+            threads_per_worker = int(os.getenv("MUSIC_THREADS_PER_WORKER", "4"))
+        if num_workers is None:
+            num_workers = max(1, len(_available_cores()) // threads_per_worker)
+        if pin_cores is None:
+            pin_cores = os.getenv("MUSIC_PIN_CORES", "1") == "1"
+        self.num_workers = num_workers
+        self.threads_per_worker = threads_per_worker
+        self.output_dir = output_dir
+        if pin_cores:
+            self._core_sets = _plan_core_sets(num_workers, threads_per_worker)
+        else:
+            self._core_sets = [None] * num_workers
+
+        self._ctx = multiprocessing.get_context("spawn")
+        self._manager = self._ctx.Manager()
+        self._cancelled = self._manager.dict()
+        self._tasks = self._ctx.Queue()
+        self._events = self._ctx.Queue()
+        self._jobs = {}
+        self._workers = {}
+        self._ready_workers = set()
+        self._running = {}  # worker_id -> job_id
+        self._pids = {}
+        self._completed = {worker_id: 0 for worker_id in range(num_workers)}
+        self._start_failures = {worker_id: 0 for worker_id in range(num_workers)}
+        self._restart_at = {}  # worker_id -> 重启时间点
+        self._given_up = set()
+        self._lock = threading.Lock()
+        self._closed = False
+
+        for worker_id in range(num_workers):
+            self._start_worker(worker_id)
+
+        self._collector = threading.Thread(target=self._collect_events, name="job-events", daemon=True)
+        self._collector.start()
+        self._monitor = threading.Thread(target=self._monitor_workers, name="job-monitor", daemon=True)
+        self._monitor.start()
+        print(f"任务池已启动: {num_workers} 个工作进程，每个 {threads_per_worker} 线程")
+
+    def _start_worker(self, worker_id):
+        process = self._ctx.Process(
+            target=_worker_main,
+            args=(worker_id, self._tasks, self._events, self._cancelled, self.threads_per_worker,
+                  self.output_dir, self._core_sets[worker_id]),
+            name=f"music-worker-{worker_id}",
+            daemon=True,
+        )
+        process.start()
+        self._workers[worker_id] = process
+
+    def submit(self, music_specs, duration_seconds=20, seed=None):
+        """提交生成任务，返回任务ID"""
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            self._prune_finished()
+            self._jobs[job_id] = {
+                "id": job_id,
+                "status": QUEUED,
+                "progress": 0.0,
+                "submitted_at": time.time(),
+                "started_at": None,
+                "finished_at": None,
+                "filename": None,
+                "prompt": None,
+                "error": None,
+                "fallback": False,
+            }
+        self._tasks.put((job_id, dict(music_specs), duration_seconds, seed))
+        return job_id
+
+    def status(self, job_id):
+        """查询任务状态（返回副本），未知任务返回None"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def result(self, job_id, timeout=None):
+        """阻塞等待任务结束，返回 (文件路径, 提示词)；生成失败改用备用音频时任务状态中 fallback 为True"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            job = self.status(job_id)
+            if job is None:
+                raise KeyError(job_id)
+            if job["status"] == DONE:
+                return job["filename"], job["prompt"]
+            if job["status"] in (FAILED, CANCELLED):
+                raise RuntimeError(f"任务{job['status']}: {job['error']}")
+            if deadline is not None and time.monotonic() > deadline:
+                raise TimeoutError(job_id)
+            time.sleep(0.2)
+
+    def cancel(self, job_id):
+        """取消任务：排队中的直接跳过；运行中的分段任务在分段之间停下，单窗口任务跑完后丢弃结果"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job["status"] in (DONE, FAILED, CANCELLED):
+                return False
+            self._cancelled[job_id] = True
+            job["status"] = CANCELLED
+            job["finished_at"] = time.time()
+        return True
+
+    def _collect_events(self):
+        while not self._closed:
+            try:
+                event = self._events.get(timeout=0.5)
+            except queue.Empty:
+                continue
+
+            kind = event[0]
+            with self._lock:
+                if kind == "ready":
+                    self._ready_workers.add(event[1])
+                    self._pids[event[1]] = event[2]
+                    self._start_failures[event[1]] = 0
+                    continue
+
+                job = self._jobs.get(event[1])
+                if job is None or job["status"] == CANCELLED:
+                    if kind in ("done", "failed", "cancelled"):
+                        self._release_worker(event[1])
+                    if kind == "done":
+                        # 取消时已在运行、没能中途停下的任务，结果不再交付
+                        try:
+                            os.remove(event[2])
+                        except OSError:
+                            pass
+                    continue
+
+                if kind == "started":
+                    job["status"] = RUNNING
+                    job["started_at"] = time.time()
+                    self._running[event[2]] = event[1]
+                elif kind == "progress":
+                    job["progress"] = event[2]
+                elif kind == "done":
+                    job["status"] = DONE
+                    job["progress"] = 1.0
+                    job["filename"], job["prompt"], job["fallback"] = event[2], event[3], event[4]
+                    job["finished_at"] = time.time()
+                    self._release_worker(event[1])
+                elif kind == "failed":
+                    job["status"] = FAILED
+                    job["error"] = event[2]
+                    job["finished_at"] = time.time()
+                    self._release_worker(event[1])
+
+    def _prune_finished(self):
+        cutoff = time.time() - FINISHED_JOB_TTL
+        for job_id, job in list(self._jobs.items()):
+            if job["finished_at"] is not None and job["finished_at"] < cutoff:
+                del self._jobs[job_id]
+                self._cancelled.pop(job_id, None)
+
+    def _release_worker(self, job_id):
+        for worker_id, running_job in list(self._running.items()):
+            if running_job == job_id:
+                del self._running[worker_id]
+                self._completed[worker_id] += 1
+
+    def _monitor_workers(self):
+        """定时巡检，重启退出的工作进程"""
+        while not self._closed:
+            time.sleep(MONITOR_INTERVAL)
+            with self._lock:
+                if self._closed:
+                    break
+                self._reap_dead_workers()
+
+    def _reap_dead_workers(self):
+        """工作进程退出时标记其任务失败，按退避间隔重启；都无法启动时排队中的任务直接失败"""
+        now = time.monotonic()
+        for worker_id, process in list(self._workers.items()):
+            if process.is_alive() or worker_id in self._given_up:
+                continue
+            if worker_id not in self._restart_at:
+                job_id = self._running.pop(worker_id, None)
+                if job_id and self._jobs[job_id]["status"] == RUNNING:
+                    self._jobs[job_id]["status"] = FAILED
+                    self._jobs[job_id]["error"] = f"工作进程异常退出 (exitcode={process.exitcode})"
+                    self._jobs[job_id]["finished_at"] = time.time()
+                self._ready_workers.discard(worker_id)
+                self._pids.pop(worker_id, None)
+
+                self._start_failures[worker_id] += 1
+                failures = self._start_failures[worker_id]
+                if failures >= MAX_WORKER_START_FAILURES:
+                    print(f"工作进程 {worker_id} 连续 {failures} 次未能就绪，不再重启")
+                    self._given_up.add(worker_id)
+                    continue
+                delay = min(WORKER_RESTART_BACKOFF * 2 ** (failures - 1), WORKER_RESTART_BACKOFF_MAX)
+                self._restart_at[worker_id] = now + delay
+            if now >= self._restart_at[worker_id]:
+                del self._restart_at[worker_id]
+                self._start_worker(worker_id)
+
+        if len(self._given_up) == len(self._workers):
+            for job_id, job in self._jobs.items():
+                if job["status"] == QUEUED:
+                    job["status"] = FAILED
+                    job["error"] = "没有能启动的工作进程"
+                    job["finished_at"] = time.time()
+
+    def stats(self):
+        """返回任务池概况"""
+        with self._lock:
+            counts = {}
+            for job in self._jobs.values():
+                counts[job["status"]] = counts.get(job["status"], 0) + 1
+            return {
+                "workers": self.num_workers,
+                "ready_workers": len(self._ready_workers),
+                "busy_workers": len(self._running),
+                "dead_workers": len(self._given_up),
+                "jobs": counts,
+                "replicas": [
+                    {
+                        "id": worker_id,
+                        "pid": self._pids.get(worker_id),
+                        "cores": self._core_sets[worker_id],
+                        "busy": worker_id in self._running,
+                        "completed": self._completed[worker_id],
+                    }
+                    for worker_id in sorted(self._workers)
+                ],
+            }
+
+    def shutdown(self):
+        """停止所有工作进程"""
+        self._closed = True
+        for _ in self._workers:
+            self._tasks.put(None)
+        for process in self._workers.values():
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        self._manager.shutdown()
@@ -0,0 +1,181 @@
+import json
+
+# 模型回复中的JSON常见不规范写法：单引号字符串、尾逗号、Python风格的 True/False/None
+_PY_LITERALS = {"True": "true", "False": "false", "None": "null"}
+
+
+def _to_strict_json(text):
+    """把单引号字符串改写为双引号字符串，去掉尾逗号；双引号字符串内容原样保留"""
+    out = []
+    i = 0
+    n = len(text)
+    while i < n:
+        ch = text[i]
+        if ch == '"':
+            j = i + 1
+            while j < n and text[j] != '"':
+                j += 2 if text[j] == "\\" else 1
+            out.append(text[i:j + 1])
+            i = j + 1
+        elif ch == "'":
+            chars = []
+            j = i + 1
+            while j < n and text[j] != "'":
+                if text[j] == "\\" and j + 1 < n:
+                    j += 1
+                chars.append(text[j])
+                j += 1
+            out.append(json.dumps("".join(chars), ensure_ascii=False))
+            i = j + 1
+        elif ch == ",":
+            rest = text[i + 1:].lstrip()
+            if not rest or rest[0] in "]}":
+                i += 1
+                continue
+            out.append(ch)
+            i += 1
+        elif ch.isalpha():
+            j = i
+            while j < n and text[j].isalnum():
+                j += 1
+            word = text[i:j]
+            out.append(_PY_LITERALS.get(word, word))
+            i = j
+        else:
+            out.append(ch)
+            i += 1
+    return "".join(out)
+
+
+def loads_tolerant(text):
+    """先按标准JSON解析，失败时修正常见不规范写法后再试"""
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        return json.loads(_to_strict_json(text))
+
+
+class IncrementalJSONParser:
+    """增量解析模型回复中的第一个JSON对象
+
+    分段喂入回复文本，顶层字段一旦完整就立即返回，不必等整段回复结束；
+    对象前后的说明文字会被忽略。
+    """
+
+    def __init__(self):
+        self._text = ""
+        self._pos = 0
+        self._depth = 0
+        self._quote = None
+        self._escaped = False
+        self._string_start = None
+        self._key = None
+        self._expecting = None  # "key" / "colon" / "value"
+        self._value_start = None
+        self._value_done = False
+        self.fields = {}
+        self.complete = False
+
+    def feed(self, chunk):
+        """追加一段文本，返回本次新完成的 [(字段名, 值), ...]"""
+        self._text += chunk
+        completed = []
+        while self._pos < len(self._text) and not self.complete:
+            self._step(self._text[self._pos], self._pos, completed)
+            self._pos += 1
+        return completed
+
+    def result(self):
+        """返回已解析出的对象；回复被截断时返回已完成的字段，什么都没有则返回None"""
+        return dict(self.fields) if self.fields else None
+
+    def _emit(self, raw, completed):
+        self._value_done = True
+        try:
+            value = loads_tolerant(raw)
+        except json.JSONDecodeError:
+            return
+        if self._key is not None:
+            self.fields[self._key] = value
+            completed.append((self._key, value))
+
+    def _step(self, ch, i, completed):
+        if self._quote is not None:
+            if self._escaped:
+                self._escaped = False
+            elif ch == "\\":
+                self._escaped = True
+            elif ch == self._quote:
+                self._quote = None
+                if self._depth == 1:
+                    raw = self._text[self._string_start:i + 1]
+                    if self._expecting == "key":
+                        try:
+                            self._key = loads_tolerant(raw)
+                        except json.JSONDecodeError:
+                            self._key = raw[1:-1]
+                        self._expecting = "colon"
+                    elif self._expecting == "value" and self._value_start == self._string_start:
+                        self._emit(raw, completed)
+            return
+
+        if self._depth == 0:
+            # 对象外的说明文字（可能含撇号）直接跳过
+            if ch == "{":
+                self._depth = 1
+                self._expecting = "key"
+            return
+
+        if ch in "\"'":
+            self._quote = ch
+            self._string_start = i
+            if self._depth == 1 and self._expecting == "value" and self._value_start is None:
+                self._value_start = i
+            return
+
+        if ch in "{[":
+            if self._depth == 1 and self._expecting == "value" and self._value_start is None:
+                self._value_start = i
+            self._depth += 1
+            return
+
+        if ch in "}]":
+            if self._depth == 1:
+                self._finish_scalar(i, completed)
+                if self.fields:
+                    self.complete = True
+                else:
+                    # 空对象或不是JSON的花括号，继续寻找下一个对象
+                    self._depth = 0
+                    self._key = None
+                return
+            self._depth -= 1
+            if self._depth == 1 and self._value_start is not None and not self._value_done:
+                self._emit(self._text[self._value_start:i + 1], completed)
+            return
+
+        if self._depth != 1:
+            return
+        if ch == ":" and self._expecting == "colon":
+            self._expecting = "value"
+            self._value_start = None
+            self._value_done = False
+        elif ch == ",":
+            self._finish_scalar(i, completed)
+            self._expecting = "key"
+            self._key = None
+            self._value_start = None
+        elif not ch.isspace() and self._expecting == "value" and self._value_start is None:
+            self._value_start = i
+
+    def _finish_scalar(self, end, completed):
+        # 数字、true/false/null 等没有结束符的值，遇到逗号或右花括号才算完整
+        if self._expecting == "value" and self._value_start is not None and not self._value_done:
+            self._emit(self._text[self._value_start:end].strip(), completed)
+
+
+def parse_json_object(text):
+    """从一段完整回复中取出第一个JSON对象，找不到时返回None"""
+    parser = IncrementalJSONParser()
+    parser.feed(text)
+    return parser.result()
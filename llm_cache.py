@@ -0,0 +1,130 @@
+import os
+import re
+import copy
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+import metrics
+
+
+def normalize_text(text):
+    """归一化用户输入：全角转半角、去标点、合并空白、统一小写"""
+    text = unicodedata.normalize("NFKC", text or "")
+    text = "".join(
+        " " if unicodedata.category(ch).startswith(("P", "S")) else ch
+        for ch in text
+    )
+    text = re.sub(r"\s+", " ", text)
+    return text.strip().lower()
+
+
+def specs_hash(specs):
+    """计算音乐描述的稳定哈希"""
+    payload = json.dumps(specs, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class LLMCache:
+    """大模型调用结果缓存：内存LRU + 可选SQLite持久层，带TTL和命中统计"""
+
+    def __init__(self, max_entries=256, ttl_seconds=24 * 3600, db_path=None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.db_path = db_path if db_path is not None else os.getenv("ZHIPU_CACHE_DB")
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        self.memory_hits = 0
+        self.sqlite_hits = 0
+        self.misses = 0
+
+        if self.db_path:
+            db_dir = os.path.dirname(self.db_path)
+            if db_dir:
+                os.makedirs(db_dir, exist_ok=True)
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            self._conn.commit()
+
+    @staticmethod
+    def analysis_key(user_input):
+        return "analyze:" + normalize_text(user_input)
+
+    @staticmethod
+    def refine_key(original_specs, user_feedback):
+        return f"refine:{specs_hash(original_specs)}:{normalize_text(user_feedback)}"
+
+    def get(self, key):
+        """查询缓存，返回结果副本或None"""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                created_at, value = entry
+                if now - created_at <= self.ttl_seconds:
+                    self._memory.move_to_end(key)
+                    self.memory_hits += 1
+                    metrics.inc("cache_requests_total", cache="llm", result="hit")
+                    return copy.deepcopy(value)
+                del self._memory[key]
+
+            if self._conn is not None:
+                row = self._conn.execute(
+                    "SELECT value, created_at FROM llm_cache WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    value, created_at = json.loads(row[0]), row[1]
+                    if now - created_at <= self.ttl_seconds:
+                        # 回填内存层
+                        self._store_memory(key, created_at, value)
+                        self.sqlite_hits += 1
+                        metrics.inc("cache_requests_total", cache="llm", result="hit")
+                        return copy.deepcopy(value)
+                    self._conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                    self._conn.commit()
+
+            self.misses += 1
+            metrics.inc("cache_requests_total", cache="llm", result="miss")
+            return None
+
+    def put(self, key, value):
+        """写入缓存"""
+        now = time.time()
+        value = copy.deepcopy(value)
+        with self._lock:
+            self._store_memory(key, now, value)
+            if self._conn is not None:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO llm_cache (key, value, created_at) VALUES (?, ?, ?)",
+                    (key, json.dumps(value, ensure_ascii=False), now),
+                )
+                self._conn.execute(
+                    "DELETE FROM llm_cache WHERE created_at < ?", (now - self.ttl_seconds,)
+                )
+                self._conn.commit()
+
+    def _store_memory(self, key, created_at, value):
+        self._memory[key] = (created_at, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def stats(self):
+        """返回命中统计"""
+        with self._lock:
+            hits = self.memory_hits + self.sqlite_hits
+            total = hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "sqlite_hits": self.sqlite_hits,
+                "misses": self.misses,
+                "hit_rate": hits / total if total else 0.0,
+                "size": len(self._memory),
+            }
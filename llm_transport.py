@@ -0,0 +1,308 @@
+import os
+import json
+import time
+import hmac
+import base64
+import random
+import asyncio
+import hashlib
+import itertools
+import threading
+import weakref
+import httpx
+import metrics
+
+DEFAULT_BASE_URL = "https://open.bigmodel.cn/api/paas/v3/model-api"
+
+# 可重试的HTTP状态码：限流和服务端错误
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+
+class CircuitOpenError(Exception):
+    """熔断器处于打开状态，调用被直接拒绝"""
+
+
+class SaturatedError(TimeoutError):
+    """等待本地并发额度超时；这是本进程的排队，不代表上游故障，不计入熔断"""
+
+
+class CircuitBreaker:
+    """连续失败达到阈值后熔断一段时间，之后放行一次试探请求"""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """是否允许发起请求"""
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    return False
+                # 冷却结束，只放行一个试探请求
+                self.state = self.HALF_OPEN
+                return True
+            if self.state == self.HALF_OPEN:
+                return False
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def release(self):
+        """试探请求没有得出结论（本地排队超时、被取消）时交还试探名额，下次调用重新试探"""
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    print(f"智谱AI连续失败 {self.failures} 次，熔断 {self.reset_timeout:.0f} 秒")
+                    metrics.inc("circuit_open_total", upstream="zhipuai")
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+def generate_token(api_key, ttl_seconds=3600):
+    """按智谱开放平台规则，用 id.secret 形式的API Key生成JWT（HS256）"""
+    try:
+        key_id, secret = api_key.split(".", 1)
+    except ValueError:
+        raise ValueError("ZHIPUAI_API_KEY 格式应为 id.secret")
+
+    def b64(data):
+        return base64.urlsafe_b64encode(data).rstrip(b"=")
+
+    now_ms = int(time.time() * 1000)
+    header = {"alg": "HS256", "sign_type": "SIGN"}
+    payload = {"api_key": key_id, "exp": now_ms + ttl_seconds * 1000, "timestamp": now_ms}
+    signing_input = b64(json.dumps(header, separators=(",", ":")).encode()) + b"." + \
+        b64(json.dumps(payload, separators=(",", ":")).encode())
+    signature = hmac.new(secret.encode(), signing_input, hashlib.sha256).digest()
+    return (signing_input + b"." + b64(signature)).decode()
+
+
+class LLMTransport:
+    """智谱AI HTTP调用：连接池复用、整体截止时间、并发上限、抖动重试和熔断
+
+    invoke/ainvoke 返回与 zhipuai.model_api.invoke 相同结构的响应字典，stream_invoke 逐段产出回复文本。
+    """
+
+    def __init__(self, api_key, base_url=None, timeout=None, max_retries=2,
+                 max_concurrency=None, breaker=None):
+        self.api_key = api_key
+        self.base_url = (base_url or os.getenv("ZHIPUAI_BASE_URL", DEFAULT_BASE_URL)).rstrip("/")
+        if timeout is None:
+            timeout = float(os.getenv("ZHIPUAI_TIMEOUT", "20"))
+        if max_concurrency is None:
+            max_concurrency = int(os.getenv("ZHIPUAI_MAX_CONCURRENCY", "8"))
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.max_concurrency = max_concurrency
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+        self._async_semaphores = weakref.WeakKeyDictionary()
+        self._token = None
+        self._token_expires = 0.0
+        limits = httpx.Limits(max_connections=max_concurrency, max_keepalive_connections=max_concurrency)
+        self._client = httpx.Client(limits=limits)
+        self._async_client = None
+        self._limits = limits
+
+    def _headers(self):
+        # 令牌有效期1小时，提前5分钟刷新
+        if self._token is None or time.time() > self._token_expires - 300:
+            self._token = generate_token(self.api_key)
+            self._token_expires = time.time() + 3600
+        return {"Authorization": self._token, "Content-Type": "application/json"}
+
+    def _request_args(self, model, prompt, params, action="invoke"):
+        url = f"{self.base_url}/{model}/{action}"
+        body = {"prompt": prompt, **params}
+        return url, body
+
+    @staticmethod
+    def _backoff(attempt):
+        # 指数退避 + 全抖动
+        return random.uniform(0, min(4.0, 0.25 * (2 ** attempt)))
+
+    @staticmethod
+    def _should_retry(error):
+        if isinstance(error, (httpx.TimeoutException, httpx.TransportError)):
+            return True
+        if isinstance(error, httpx.HTTPStatusError):
+            return error.response.status_code in RETRYABLE_STATUS
+        return False
+
+    def invoke(self, model, prompt, timeout=None, **params):
+        """同步调用；timeout 为包含重试在内的整体截止时间"""
+        if not self.breaker.allow():
+            raise CircuitOpenError("智谱AI熔断中")
+        deadline = time.monotonic() + (timeout or self.timeout)
+        url, body = self._request_args(model, prompt, params)
+
+        remaining = deadline - time.monotonic()
+        if not self._semaphore.acquire(timeout=max(0.0, remaining)):
+            self.breaker.release()
+            raise SaturatedError("等待智谱AI并发额度超时")
+        try:
+            for attempt in range(self.max_retries + 1):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    response = self._client.post(url, json=body, headers=self._headers(), timeout=remaining)
+                    response.raise_for_status()
+                    self.breaker.record_success()
+                    return response.json()
+                except Exception as e:
+                    if not self._should_retry(e) or attempt == self.max_retries:
+                        self.breaker.record_failure()
+                        raise
+                    metrics.inc("llm_retries_total")
+                    time.sleep(min(self._backoff(attempt), max(0.0, deadline - time.monotonic())))
+            self.breaker.record_failure()
+            raise TimeoutError("智谱AI调用超过截止时间")
+        finally:
+            self._semaphore.release()
+
+    def stream_invoke(self, model, prompt, timeout=None, **params):
+        """流式调用（SSE），逐段产出回复文本；只在收到首段之前重试"""
+        if not self.breaker.allow():
+            raise CircuitOpenError("智谱AI熔断中")
+        deadline = time.monotonic() + (timeout or self.timeout)
+        url, body = self._request_args(model, prompt, params, action="sse-invoke")
+        headers = dict(self._headers(), Accept="text/event-stream")
+
+        if not self._semaphore.acquire(timeout=max(0.0, deadline - time.monotonic())):
+            self.breaker.release()
+            raise SaturatedError("等待智谱AI并发额度超时")
+        try:
+            for attempt in range(self.max_retries + 1):
+                received = False
+                try:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise TimeoutError("智谱AI调用超过截止时间")
+                    with self._client.stream("POST", url, json=body, headers=headers, timeout=remaining) as response:
+                        response.raise_for_status()
+                        for piece in self._iter_sse(response, deadline):
+                            received = True
+                            yield piece
+                    self.breaker.record_success()
+                    return
+                except Exception as e:
+                    # 已经交出部分内容后不能重试，否则调用方会收到重复文本
+                    if received or not self._should_retry(e) or attempt == self.max_retries:
+                        self.breaker.record_failure()
+                        raise
+                    metrics.inc("llm_retries_total")
+                    time.sleep(min(self._backoff(attempt), max(0.0, deadline - time.monotonic())))
+                except BaseException:
+                    # 调用方中途放弃（关闭生成器）：已收到内容说明上游正常，否则不计成败，都要交还试探名额
+                    if received:
+                        self.breaker.record_success()
+                    else:
+                        self.breaker.release()
+                    raise
+        finally:
+            self._semaphore.release()
+
+    @staticmethod
+    def _iter_sse(response, deadline):
+        """解析SSE事件流：add/finish 事件的 data 为回复片段，多行 data 以换行拼接"""
+        event, data = None, []
+        # 末尾补一个空行，确保最后一个事件被处理
+        for line in itertools.chain(response.iter_lines(), [""]):
+            if time.monotonic() > deadline:
+                raise TimeoutError("智谱AI调用超过截止时间")
+            if line:
+                field, _, value = line.partition(":")
+                if value.startswith(" "):
+                    value = value[1:]
+                if field == "event":
+                    event = value
+                elif field == "data":
+                    data.append(value)
+                continue
+            text = "\n".join(data)
+            if event in ("error", "interrupted"):
+                raise RuntimeError(f"智谱AI流式响应中断: {text}")
+            if data:
+                yield text
+            event, data = None, []
+
+    def _get_async_semaphore(self):
+        # asyncio.Semaphore 绑定事件循环，每个循环各建一个；循环销毁后随之释放
+        loop = asyncio.get_running_loop()
+        semaphore = self._async_semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self._async_semaphores[loop] = asyncio.Semaphore(self.max_concurrency)
+        return semaphore
+
+    async def ainvoke(self, model, prompt, timeout=None, **params):
+        """异步调用，语义与 invoke 相同"""
+        if not self.breaker.allow():
+            raise CircuitOpenError("智谱AI熔断中")
+        if self._async_client is None:
+            self._async_client = httpx.AsyncClient(limits=self._limits)
+        deadline = time.monotonic() + (timeout or self.timeout)
+        url, body = self._request_args(model, prompt, params)
+        acquired = False
+
+        async def attempt_all():
+            nonlocal acquired
+            async with self._get_async_semaphore():
+                acquired = True
+                for attempt in range(self.max_retries + 1):
+                    try:
+                        response = await self._async_client.post(
+                            url, json=body, headers=self._headers(),
+                            timeout=max(0.0, deadline - time.monotonic())
+                        )
+                        response.raise_for_status()
+                        return response.json()
+                    except Exception as e:
+                        if not self._should_retry(e) or attempt == self.max_retries:
+                            raise
+                        metrics.inc("llm_retries_total")
+                        await asyncio.sleep(self._backoff(attempt))
+
+        try:
+            result = await asyncio.wait_for(attempt_all(), max(0.0, deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            if not acquired:
+                self.breaker.release()
+                raise SaturatedError("等待智谱AI并发额度超时")
+            self.breaker.record_failure()
+            raise
+        except Exception:
+            self.breaker.record_failure()
+            raise
+        except BaseException:
+            # 被取消时没有结论，不计成败，但要交还试探名额
+            self.breaker.release()
+            raise
+        self.breaker.record_success()
+        return result
+
+    def close(self):
+        self._client.close()
+
+    async def aclose(self):
+        if self._async_client is not None:
+            await self._async_client.aclose()
+            self._async_client = None
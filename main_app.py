@@ -3,7 +3,16 @@ import os
 import tempfile
 from datetime import datetime
 import base64
-from music_generator import MusicGenerator
+import time
+import random
+from streamlit import runtime
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+from audio_store import AudioStore
+import metrics
+from audio_utils import DELIVERY_FORMATS, encode_audio
+from music_generator import MusicGenerator, STATUS_LABELS, STATUS_READY, STATUS_FAILED, memory_usage_mb
+from job_queue import JobManager, DONE, FAILED, CANCELLED
+from preset_library import PresetLibrary, PRESETS
 from zhipu_client import ZhipuClient
 
 # 页面配置
@@ -19,23 +28,202 @@ st.set_page_config(
 def get_zhipu_client():
     return ZhipuClient()
 
+@st.cache_resource
+def get_audio_store():
+    return AudioStore()
+
 @st.cache_resource
 def get_music_generator():
-    return MusicGenerator()
+    generator = MusicGenerator(output_dir=get_audio_store().incoming_dir)
+    # 启动即在后台加载并预热模型；使用独立工作进程时由工作进程负责加载
+    if get_job_manager() is None:
+        generator.start_background_load()
+    return generator
 
-def autoplay_audio(file_path):
-    """自动播放音频"""
-    with open(file_path, "rb") as f:
-        data = f.read()
-    b64 = base64.b64encode(data).decode()
-    md = f"""
+@st.cache_resource
+def get_job_manager():
+    """设置 MUSIC_WORKERS 后在独立进程中生成音乐（auto 表示按CPU核数）"""
+    workers = os.getenv("MUSIC_WORKERS", "").strip()
+    if not workers or workers == "0":
+        return None
+    return JobManager(
+        num_workers=None if workers == "auto" else int(workers),
+        output_dir=get_audio_store().incoming_dir
+    )
+
+@st.cache_resource
+def get_preset_library():
+    """示例预设的预生成音频库；使用独立工作进程时本进程不持有模型，不启用"""
+    if get_job_manager() is not None:
+        return None
+    library = PresetLibrary(get_music_generator(), get_zhipu_client().analyze_music_request)
+    library.start()
+    return library
+
+def fill_example(text):
+    st.session_state.user_input = text
+
+def current_session_id():
+    """当前Streamlit会话ID，用于归属生成的音频文件"""
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx else "default"
+
+def is_session_active(session_id):
+    """判断会话是否仍然在线；无法判断时视为在线，避免误删"""
+    try:
+        return runtime.get_instance().is_active_session(session_id)
+    except Exception:
+        return True
+
+def keep_generated_audio(audio_file):
+    """把生成的文件交给托管存储，归属到当前会话"""
+    return get_audio_store().adopt(audio_file, current_session_id())
+
+def render_job_status():
+    """显示后台任务进度；任务结束时把结果写入session state"""
+    job_id = st.session_state.get("job_id")
+    if not job_id:
+        return
+    
+    job_manager = get_job_manager()
+    job = job_manager.status(job_id)
+    if job is None:
+        st.session_state.job_id = None
+        return
+    
+    if job["status"] == DONE:
+        st.session_state.job_id = None
+        st.session_state.generated_audio = keep_generated_audio(job["filename"])
+        st.session_state.music_prompt = job["prompt"]
+        st.session_state.step = 2
+        st.session_state.generated_count += 1
+    elif job["status"] == FAILED:
+        st.session_state.job_id = None
+        st.error(f"音乐生成失败: {job['error']}")
+    elif job["status"] == CANCELLED:
+        st.session_state.job_id = None
+        st.warning("已取消本次生成")
+    else:
+        waiting = "排队中" if job["progress"] == 0 and job["started_at"] is None else "生成中"
+        st.progress(job["progress"], text=f"AI正在创作音乐（{waiting}）...")
+        if st.button("取消生成", key=f"cancel_{job_id}"):
+            job_manager.cancel(job_id)
+            st.rerun()
+        # 定时轮询任务状态，生成过程不占用页面线程
+        time.sleep(1)
+        st.rerun()
+
+@st.cache_resource
+def start_metrics_export():
+    """设置 MUSIC_METRICS_PORT 时启动 /metrics 接口"""
+    return metrics.start_http_server()
+
+def render_metrics_panel():
+    """侧边栏：各阶段耗时、实时率和回退/错误计数"""
+    summary = metrics.stage_summary()
+    rtf = metrics.histogram_summary("real_time_factor")
+    fallbacks = sum(metrics.counter_values("fallbacks_total").values())
+    errors = sum(metrics.counter_values("errors_total").values())
+    
+    col_m1, col_m2, col_m3 = st.columns(3)
+    col_m1.metric("实时率p50", f"{rtf['p50']:.2f}" if rtf else "-")
+    col_m2.metric("回退次数", int(fallbacks))
+    col_m3.metric("错误次数", int(errors))
+    
+    if summary:
+        with st.expander("各阶段耗时"):
+            st.table([
+                {
+                    "阶段": stage,
+                    "次数": stat["count"],
+                    "平均(ms)": f"{stat['mean'] * 1000:.0f}",
+                    "p50(ms)": f"{stat['p50'] * 1000:.0f}",
+                    "p95(ms)": f"{stat['p95'] * 1000:.0f}",
+                }
+                for stage, stat in sorted(summary.items())
+            ])
+
+def get_audio_result(file_path):
+    """把生成结果读入内存并只压缩编码一次，播放器、自动播放和下载共用这一份数据"""
+    result = st.session_state.get("audio_result")
+    if result and result["path"] == file_path:
+        return result
+    
+    fmt = os.getenv("MUSIC_DELIVERY_FORMAT", "FLAC").upper()
+    if fmt not in DELIVERY_FORMATS:
+        fmt = "FLAC"
+    sampling_rate, data = get_audio_store().read(file_path)
+    result = {
+        "path": file_path,
+        "format": fmt,
+        "data": encode_audio(data, sampling_rate, fmt),
+        "b64": None,
+        "wav": None,
+    }
+    st.session_state.audio_result = result
+    return result
+
+def autoplay_html(b64, mime):
+    """自动播放的音频播放器HTML"""
+    return f"""
     <audio controls autoplay style="width: 100%;">
-        <source src="data:audio/wav;base64,{b64}" type="audio/wav">
+        <source src="data:{mime};base64,{b64}" type="{mime}">
     </audio>
     """
-    st.markdown(md, unsafe_allow_html=True)
+
+def autoplay_audio(audio_result):
+    """自动播放音频"""
+    if audio_result["b64"] is None:
+        audio_result["b64"] = base64.b64encode(audio_result["data"]).decode()
+    mime = DELIVERY_FORMATS[audio_result["format"]][1]
+    st.markdown(autoplay_html(audio_result["b64"], mime), unsafe_allow_html=True)
+
+def stream_to_page(music_gen, music_specs, duration):
+    """流式生成并在页面上逐段自动播放，返回完整音频文件和提示词
+    
+    页面上只有一个播放器，每段播完后替换为下一段；生成快于播放且还有下一段时才暂停，
+    避免切断正在播放的段落。最后一段不等它播完，直接由「生成结果」展示完整文件。
+    命中缓存（或合并到进行中的相同生成）时一次拿到完整音频，不再内嵌播放器。
+    """
+    progress = st.progress(0.0, text="正在生成第一段音乐...")
+    player = st.empty()
+    generated_seconds = 0.0
+    audio_file, prompt = None, None
+    play_until = 0.0
+    
+    try:
+        for part in music_gen.stream_music(music_specs, duration):
+            if part["complete"]:
+                audio_file, prompt = part["filename"], part["prompt"]
+                break
+            block_seconds = len(part["audio"]) / part["sampling_rate"]
+            generated_seconds += block_seconds
+            audio_file, prompt = part["filename"], part["prompt"]
+            
+            # 第一段到达后立即开始播放，之后等上一段播完再换下一段
+            time.sleep(max(0.0, play_until - time.monotonic()))
+            data = encode_audio(part["audio"], part["sampling_rate"], "WAV")
+            player.markdown(autoplay_html(base64.b64encode(data).decode(), "audio/wav"), unsafe_allow_html=True)
+            play_until = time.monotonic() + block_seconds
+            progress.progress(
+                min(generated_seconds / duration, 1.0),
+                text=f"已生成 {generated_seconds:.0f}/{duration} 秒"
+            )
+    except Exception as e:
+        print(f"流式生成失败，改用整段生成: {e}")
+        player.empty()
+        audio_file, prompt = music_gen.generate_music(music_specs, duration)
+    
+    progress.empty()
+    return audio_file, prompt
 
 def main():
+    start_metrics_export()
+    # 设置 MUSIC_METRICS_FILE 时每次页面运行刷新一次指标文件
+    metrics.write_metrics_file()
+    # 回收已关闭会话留下的音频文件（内部按时间间隔节流）
+    get_audio_store().reclaim(is_session_active)
+    
     # 标题和介绍
     st.title("🎵 AI音乐创作助手")
     st.markdown("""
@@ -72,6 +260,47 @@ def main():
         if 'generated_count' not in st.session_state:
             st.session_state.generated_count = 0
         st.metric("已生成音乐", st.session_state.generated_count)
+        music_gen = get_music_generator()
+        model_status = STATUS_LABELS[music_gen.status]
+        if get_job_manager() is not None:
+            st.info("模型：由后台工作进程加载")
+        elif music_gen.status == STATUS_READY:
+            st.success(f"模型：{model_status}")
+        elif music_gen.status == STATUS_FAILED:
+            st.error(f"模型：{model_status}（{music_gen.load_error}）")
+        else:
+            st.info(f"模型：{model_status}")
+        memory = memory_usage_mb()
+        if "rss" in memory:
+            st.metric("进程内存", f"{memory['rss']:.0f} MB", help=f"其中映射的模型文件 {memory.get('file', 0):.0f} MB")
+        cache_stats = music_gen.audio_cache.stats()
+        st.metric(
+            "音频缓存命中",
+            f"{cache_stats['hits']}/{cache_stats['hits'] + cache_stats['misses']}",
+        )
+        text_stats = music_gen.text_cache.stats()
+        st.metric("文本编码缓存命中率", f"{text_stats['hit_rate']:.0%}")
+        llm_stats = get_zhipu_client().cache.stats()
+        st.metric("需求分析缓存命中率", f"{llm_stats['hit_rate']:.0%}")
+        coalesced = music_gen.inflight.stats()["coalesced"] + get_zhipu_client().inflight_analysis.stats()["coalesced"]
+        st.metric("合并的重复请求", coalesced)
+        router = get_zhipu_client().router
+        if router is not None:
+            st.metric("本地识别占比", f"{router.stats()['local_rate']:.0%}")
+        library = get_preset_library()
+        if library is not None:
+            preset_stats = library.stats()
+            st.metric("预设就绪版本", f"{preset_stats['ready']}/{preset_stats['target']}")
+        store_stats = get_audio_store().stats()
+        st.metric(
+            "音频存储占用",
+            f"{store_stats['bytes'] / 1024 / 1024:.1f}/{store_stats['max_bytes'] / 1024 / 1024:.0f} MB"
+        )
+        job_manager = get_job_manager()
+        if job_manager is not None:
+            pool_stats = job_manager.stats()
+            st.metric("忙碌工作进程", f"{pool_stats['busy_workers']}/{pool_stats['workers']}")
+        render_metrics_panel()
     
     # 初始化session state
     if 'music_specs' not in st.session_state:
@@ -93,38 +322,55 @@ def main():
         duration = st.slider(
             "选择音乐时长（秒）",
             min_value=15,
-            max_value=30,
+            max_value=300,
             value=20,
-            help="较长的音乐需要更多的生成时间"
+            step=5,
+            help="较长的音乐需要更多的生成时间，超过30秒将分段生成并自动衔接"
         )
         
         # 用户输入
         user_input = st.text_area(
             "请详细描述你想要的音乐：",
             placeholder="例如：\n• 欢快的电子游戏背景音乐，带有钢琴和鼓点\n• 悲伤的钢琴曲，适合失恋时听\n• 中国古风音乐，使用古筝和笛子\n• 激昂的战斗配乐，有强烈的节奏感",
-            height=100
+            height=100,
+            key="user_input"
         )
         
-        # 快速示例按钮
+        # 快速示例按钮：点击后把示例描述填入输入框（回调在页面重新运行前执行）
         example_col1, example_col2, example_col3, example_col4 = st.columns(4)
         with example_col1:
-            if st.button("🎮 游戏配乐", use_container_width=True):
-                user_input = "电子游戏背景音乐，欢快活泼，有电子合成器和鼓点"
+            st.button("🎮 游戏配乐", use_container_width=True,
+                      on_click=fill_example, args=(PRESETS["游戏配乐"],))
         with example_col2:
-            if st.button("😢 悲伤钢琴", use_container_width=True):
-                user_input = "悲伤的钢琴曲，缓慢的节奏，表达失落的情感"
+            st.button("😢 悲伤钢琴", use_container_width=True,
+                      on_click=fill_example, args=(PRESETS["悲伤钢琴"],))
         with example_col3:
-            if st.button("🏮 中国古风", use_container_width=True):
-                user_input = "中国古风音乐，使用古筝和笛子，优雅传统"
+            st.button("🏮 中国古风", use_container_width=True,
+                      on_click=fill_example, args=(PRESETS["中国古风"],))
         with example_col4:
-            if st.button("⚡ 激昂战斗", use_container_width=True):
-                user_input = "激昂的战斗配乐，强烈的节奏，使用管弦乐和打击乐"
+            st.button("⚡ 激昂战斗", use_container_width=True,
+                      on_click=fill_example, args=(PRESETS["激昂战斗"],))
+        
+        stream_playback = st.checkbox(
+            "边生成边播放",
+            value=True,
+            help="每生成完一小段就开始播放，无需等待整首音乐完成"
+        )
         
         if st.button("生成音乐", type="primary", use_container_width=True) and user_input:
+            # 示例预设有预生成的版本时直接交付
+            library = get_preset_library()
+            preset = library.take(user_input, duration) if library is not None else None
+            
             with st.spinner("AI正在分析你的音乐需求..."):
-                # 分析用户需求
-                zhipu_client = get_zhipu_client()
-                st.session_state.music_specs = zhipu_client.analyze_music_request(user_input)
+                if preset is not None:
+                    st.session_state.music_specs = preset[0]
+                else:
+                    # 分析用户需求
+                    zhipu_client = get_zhipu_client()
+                    # 本进程内生成时，提示词一解析出来就开始文本编码，与回复的剩余部分并行
+                    on_prompt = get_music_generator().prefetch_prompt if get_job_manager() is None else None
+                    st.session_state.music_specs = zhipu_client.analyze_music_request(user_input, on_prompt=on_prompt)
                 
                 # 更新时长设置
                 st.session_state.music_specs["duration"] = duration
@@ -143,15 +389,28 @@ def main():
                     instruments = ", ".join(specs.get('instruments', []))
                     st.metric("主要乐器", instruments if instruments else "未指定")
             
-            with st.spinner(f"AI正在创作{duration}秒音乐，这可能需要1-3分钟..."):
-                # 生成音乐
-                music_gen = get_music_generator()
-                audio_file, prompt = music_gen.generate_music(st.session_state.music_specs, duration)
-                
-                st.session_state.generated_audio = audio_file
-                st.session_state.music_prompt = prompt
-                st.session_state.step = 2
-                st.session_state.generated_count += 1
+            if preset is not None:
+                audio_file, prompt = preset[1], preset[2]
+            else:
+                with st.spinner(f"AI正在创作{duration}秒音乐，这可能需要1-3分钟..."):
+                    # 生成音乐
+                    job_manager = get_job_manager()
+                    if job_manager is not None:
+                        st.session_state.job_id = job_manager.submit(st.session_state.music_specs, duration)
+                        st.rerun()
+                    
+                    music_gen = get_music_generator()
+                    if stream_playback:
+                        audio_file, prompt = stream_to_page(music_gen, st.session_state.music_specs, duration)
+                    else:
+                        audio_file, prompt = music_gen.generate_music(
+                            st.session_state.music_specs, duration, session_id=current_session_id()
+                        )
+            
+            st.session_state.generated_audio = keep_generated_audio(audio_file)
+            st.session_state.music_prompt = prompt
+            st.session_state.step = 2
+            st.session_state.generated_count += 1
     
     with col2:
         st.subheader("📋 创作进度")
@@ -174,6 +433,8 @@ def main():
         if st.session_state.generated_audio:
             st.success("音乐已生成完成！")
     
+    render_job_status()
+    
     # 显示生成结果
     if st.session_state.generated_audio and st.session_state.step >= 2:
         st.markdown("---")
@@ -183,22 +444,56 @@ def main():
         with st.expander("查看AI使用的详细提示词"):
             st.code(st.session_state.music_prompt, language="text")
         
-        # 播放音频
-        st.audio(st.session_state.generated_audio)
+        # 播放音频（使用内存中的压缩数据，不再重复读取文件）
+        audio_result = get_audio_result(st.session_state.generated_audio)
+        ext, mime = DELIVERY_FORMATS[audio_result["format"]][:2]
+        st.audio(audio_result["data"], format=mime)
         
         # 自动播放（可选）
         if st.checkbox("自动播放生成的音乐"):
-            autoplay_audio(st.session_state.generated_audio)
+            autoplay_audio(audio_result)
         
         # 下载按钮
-        with open(st.session_state.generated_audio, "rb") as f:
-            st.download_button(
-                label="📥 下载音乐文件",
-                data=f,
-                file_name=os.path.basename(st.session_state.generated_audio),
-                mime="audio/wav",
-                use_container_width=True
-            )
+        download_format = st.radio(
+            "下载格式",
+            [audio_result["format"], "WAV"] if audio_result["format"] != "WAV" else ["WAV"],
+            horizontal=True
+        )
+        if download_format == audio_result["format"]:
+            download_data, download_ext, download_mime = audio_result["data"], ext, mime
+        else:
+            # 从源文件编码，而不是解码有损的交付格式再转换
+            if audio_result.get("wav") is None:
+                sampling_rate, data = get_audio_store().read(audio_result["path"])
+                audio_result["wav"] = encode_audio(data, sampling_rate, "WAV")
+            download_data = audio_result["wav"]
+            download_ext, download_mime = "wav", "audio/wav"
+        base_name = os.path.splitext(os.path.basename(st.session_state.generated_audio))[0]
+        st.download_button(
+            label="📥 下载音乐文件",
+            data=download_data,
+            file_name=f"{base_name}.{download_ext}",
+            mime=download_mime,
+            use_container_width=True
+        )
+        
+        # 同样的需求换一个随机种子，不取缓存里的同一版本
+        if st.button("🎲 换一个版本", use_container_width=True):
+            job_manager = get_job_manager()
+            if job_manager is not None:
+                st.session_state.job_id = job_manager.submit(
+                    st.session_state.music_specs, duration, seed=random.randrange(2 ** 31)
+                )
+                st.rerun()
+            
+            with st.spinner("AI正在创作另一个版本..."):
+                audio_file, prompt = get_music_generator().generate_music(
+                    st.session_state.music_specs, duration, session_id=current_session_id(), variant=True
+                )
+            st.session_state.generated_audio = keep_generated_audio(audio_file)
+            st.session_state.music_prompt = prompt
+            st.session_state.generated_count += 1
+            st.rerun()
         
         # 反馈和优化
         st.subheader("🔄 优化音乐")
@@ -206,6 +501,11 @@ def main():
             "对生成的音乐有什么反馈？我们可以优化：",
             placeholder="例如：节奏再快一点、加入更多钢琴元素、情绪再悲伤一些..."
         )
+        keep_opening = st.checkbox(
+            "保留开头，只重写后半段",
+            value=True,
+            help="沿用上一版的前半段作为条件，只重新生成后半段，速度约为完整生成的一半"
+        )
         
         if st.button("根据反馈重新生成", use_container_width=True) and feedback:
             with st.spinner("根据反馈优化音乐..."):
@@ -220,10 +520,24 @@ def main():
                 st.session_state.music_specs = new_specs
                 
                 # 重新生成音乐
+                job_manager = get_job_manager()
+                if job_manager is not None:
+                    st.session_state.job_id = job_manager.submit(new_specs, duration)
+                    st.rerun()
+                
                 music_gen = get_music_generator()
-                audio_file, prompt = music_gen.generate_music(new_specs, duration)
+                if keep_opening:
+                    audio_file, prompt = music_gen.refine_music(
+                        new_specs, duration,
+                        session_id=current_session_id(),
+                        previous_file=st.session_state.generated_audio
+                    )
+                else:
+                    audio_file, prompt = music_gen.generate_music(
+                        new_specs, duration, session_id=current_session_id()
+                    )
                 
-                st.session_state.generated_audio = audio_file
+                st.session_state.generated_audio = keep_generated_audio(audio_file)
                 st.session_state.music_prompt = prompt
                 
                 st.success("音乐已根据反馈重新生成！")
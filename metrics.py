@@ -0,0 +1,210 @@
+import os
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 进程内指标注册表：计数器和直方图，可导出为Prometheus文本格式
+
+METRIC_PREFIX = "music_ai_"
+
+# 阶段耗时（秒）的分桶
+DURATION_BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+# 实时率（推理耗时 / 音频时长）的分桶
+RTF_BUCKETS = (0.25, 0.5, 1, 2, 4, 8, 16, 32)
+
+HELP = {
+    "stage_duration_seconds": "各阶段耗时",
+    "real_time_factor": "推理耗时与生成音频时长之比",
+    "cache_requests_total": "缓存查询次数",
+    "fallbacks_total": "使用备用方案的次数",
+    "errors_total": "各阶段出错次数",
+    "llm_retries_total": "大模型调用重试次数",
+    "circuit_open_total": "熔断器打开次数",
+    "intent_route_total": "需求分析走本地识别或大模型的次数",
+    "refinements_total": "只重写结尾的增量优化次数",
+    "model_unloads_total": "空闲释放模型的次数",
+    "inflight_coalesced_total": "合并到进行中相同请求的次数",
+}
+
+# 每个直方图保留最近的样本用于界面上的分位数展示
+RECENT_SAMPLES = 512
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+
+
+class _Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.recent = deque(maxlen=RECENT_SAMPLES)
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.recent.append(value)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.bucket_counts[i] += 1
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name, amount=1, **labels):
+    """计数器加一（或加指定值）"""
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def observe(name, value, buckets=DURATION_BUCKETS, **labels):
+    """记录一个直方图样本"""
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = _Histogram(buckets)
+        histogram.observe(value)
+
+
+@contextmanager
+def span(stage):
+    """计时一个阶段；阶段内抛出异常时同时计入错误数"""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        inc("errors_total", stage=stage)
+        raise
+    finally:
+        observe("stage_duration_seconds", time.perf_counter() - start, stage=stage)
+
+
+def _percentile(values, q):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(q / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def stage_summary():
+    """各阶段耗时概况：次数、平均、p50、p95（秒）"""
+    summary = {}
+    with _lock:
+        for (name, labels), histogram in _histograms.items():
+            if name != "stage_duration_seconds" or not histogram.count:
+                continue
+            stage = dict(labels)["stage"]
+            summary[stage] = {
+                "count": histogram.count,
+                "mean": histogram.sum / histogram.count,
+                "p50": _percentile(histogram.recent, 50),
+                "p95": _percentile(histogram.recent, 95),
+            }
+    return summary
+
+
+def counter_values(name):
+    """返回某个计数器在各标签下的取值"""
+    with _lock:
+        return {labels: value for (key, labels), value in _counters.items() if key == name}
+
+
+def histogram_summary(name, **labels):
+    """返回某个直方图的次数、平均值和p50，没有样本时返回None"""
+    with _lock:
+        histogram = _histograms.get(_key(name, labels))
+        if histogram is None or not histogram.count:
+            return None
+        return {
+            "count": histogram.count,
+            "mean": histogram.sum / histogram.count,
+            "p50": _percentile(histogram.recent, 50),
+        }
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+
+def render_prometheus():
+    """导出为Prometheus文本格式"""
+    lines = []
+    with _lock:
+        counters = sorted(_counters.items())
+        histograms = sorted(_histograms.items(), key=lambda item: item[0])
+
+        seen = set()
+        for (name, labels), value in counters:
+            full_name = METRIC_PREFIX + name
+            if full_name not in seen:
+                seen.add(full_name)
+                lines.append(f"# HELP {full_name} {HELP.get(name, name)}")
+                lines.append(f"# TYPE {full_name} counter")
+            lines.append(f"{full_name}{_format_labels(labels)} {value}")
+
+        for (name, labels), histogram in histograms:
+            full_name = METRIC_PREFIX + name
+            if full_name not in seen:
+                seen.add(full_name)
+                lines.append(f"# HELP {full_name} {HELP.get(name, name)}")
+                lines.append(f"# TYPE {full_name} histogram")
+            for bound, count in zip(histogram.buckets, histogram.bucket_counts):
+                lines.append(f"{full_name}_bucket{_format_labels(labels, [('le', bound)])} {count}")
+            lines.append(f"{full_name}_bucket{_format_labels(labels, [('le', '+Inf')])} {histogram.count}")
+            lines.append(f"{full_name}_sum{_format_labels(labels)} {histogram.sum}")
+            lines.append(f"{full_name}_count{_format_labels(labels)} {histogram.count}")
+    return "\n".join(lines) + "\n"
+
+
+def write_metrics_file(path=None):
+    """原子地写出指标文件（供 node_exporter textfile collector 采集）"""
+    path = path or os.getenv("MUSIC_METRICS_FILE")
+    if not path:
+        return None
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(render_prometheus())
+    os.replace(tmp_path, path)
+    return path
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.rstrip("/") != "/metrics":
+            self.send_error(404)
+            return
+        body = render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+_server = None
+
+
+def start_http_server(port=None):
+    """在后台线程提供 /metrics 接口；未配置端口时不启动"""
+    global _server
+    if port is None:
+        port = os.getenv("MUSIC_METRICS_PORT")
+    if not port or _server is not None:
+        return _server
+    _server = ThreadingHTTPServer(("0.0.0.0", int(port)), _MetricsHandler)
+    threading.Thread(target=_server.serve_forever, name="metrics-http", daemon=True).start()
+    print(f"指标接口已启动: http://0.0.0.0:{port}/metrics")
+    return _server
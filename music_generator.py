@@ -1,29 +1,233 @@
-from transformers import pipeline
-import scipy.io.wavfile
-import torch
+import gc
 import os
+import random
+import shutil
+import time
+import threading
+import contextlib
 from datetime import datetime
+from collections import OrderedDict
 import numpy as np
 import tempfile
+import soundfile as sf
+from audio_cache import AudioCache
+from batch_scheduler import BatchScheduler
+from audio_utils import AudioPostProcessor, array_source, chord_blocks, equal_power_crossfade
+from text_encoding_cache import TextEncodingCache
+from single_flight import SingleFlight
+import metrics
+
+# torch / transformers 导入较慢，统一推迟到真正需要时再导入
+
+MODEL_ID = "facebook/musicgen-small"
+# 下载到本地模型目录的文件，跳过与 safetensors 重复的 pytorch_model.bin
+MODEL_FILE_PATTERNS = ["*.json", "*.safetensors", "*.model", "*.txt"]
+TOKENS_PER_SECOND = 50  # MusicGen的经验值
+MAX_WINDOW_TOKENS = 1500  # 单次推理上限（约30秒），超过则走分段长音频模式
+
+# 模型就绪状态
+STATUS_IDLE = "idle"
+STATUS_LOADING = "loading"
+STATUS_WARMING = "warming"
+STATUS_READY = "ready"
+STATUS_FAILED = "failed"
+STATUS_UNLOADED = "unloaded"
+
+# CPU推理模式：fp32 原始精度；bf16 自动混合精度；int8 解码器线性层动态量化
+INFERENCE_MODES = ("fp32", "bf16", "int8")
+
+STATUS_LABELS = {
+    STATUS_IDLE: "未加载",
+    STATUS_LOADING: "模型加载中",
+    STATUS_WARMING: "模型预热中",
+    STATUS_READY: "就绪",
+    STATUS_FAILED: "加载失败",
+    STATUS_UNLOADED: "空闲已释放（下次请求自动加载）",
+}
+
+
+def memory_usage_mb():
+    """当前进程的内存占用（MB）：rss 为常驻总量，anon 为私有匿名页，file 为文件映射页"""
+    names = {"VmRSS": "rss", "RssAnon": "anon", "RssFile": "file"}
+    usage = {}
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key in names:
+                    usage[names[key]] = int(value.split()[0]) / 1024
+    except OSError:
+        pass
+    return usage
+
+
+def _format_memory(usage):
+    if "rss" not in usage:
+        return "未知"
+    return f"RSS {usage['rss']:.0f} MB（匿名 {usage.get('anon', 0):.0f} / 映射 {usage.get('file', 0):.0f}）"
+
+
+def _release_free_memory():
+    """把已释放的堆内存归还给操作系统（仅 glibc）"""
+    try:
+        import ctypes
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
 
 class MusicGenerator:
-    def __init__(self):
+    def __init__(self, audio_cache=None, inference_mode=None, use_compile=None, num_threads=None,
+                 output_dir=None, mmap_weights=None, model_dir=None, idle_unload_seconds=None,
+                 postprocessor=None):
+        if inference_mode is None:
+            inference_mode = os.getenv("MUSIC_INFERENCE_MODE", "fp32")
+        if inference_mode not in INFERENCE_MODES:
+            raise ValueError(f"不支持的推理模式: {inference_mode}，可选 {INFERENCE_MODES}")
+        if use_compile is None:
+            use_compile = os.getenv("MUSIC_TORCH_COMPILE", "0") == "1"
+        if num_threads is None and os.getenv("MUSIC_NUM_THREADS"):
+            num_threads = int(os.getenv("MUSIC_NUM_THREADS"))
+        if mmap_weights is None:
+            mmap_weights = os.getenv("MUSIC_MMAP_WEIGHTS", "1") == "1"
+        if model_dir is None:
+            model_dir = os.getenv("MUSIC_MODEL_DIR") or None
+        if idle_unload_seconds is None:
+            idle_unload_seconds = float(os.getenv("MUSIC_IDLE_UNLOAD_SECONDS", "0"))
+        self.inference_mode = inference_mode
+        # 权重改为映射 safetensors 文件，多个进程共享同一份只读页面
+        self.mmap_weights = mmap_weights
+        # 生成文件的输出目录，默认使用系统临时目录
+        self.output_dir = output_dir or os.getenv("MUSIC_OUTPUT_DIR") or None
+        if self.output_dir:
+            os.makedirs(self.output_dir, exist_ok=True)
+        self.use_compile = use_compile
+        self.num_threads = num_threads
         self.model_loaded = False
         self.pipe = None
-        self.current_device = "cuda" if torch.cuda.is_available() else "cpu"
-        print(f"使用设备: {self.current_device}")
+        self.processor = None
+        self.model_id = MODEL_ID
+        # 固定的本地模型目录：不存在时下载一次，之后完全离线加载
+        self.model_dir = model_dir
+        self.model_revision = os.getenv("MUSIC_MODEL_REVISION", "main")
+        self.offline = os.getenv("MUSIC_OFFLINE", os.getenv("HF_HUB_OFFLINE", "0")) == "1"
+        self.model_source = None
+        # 空闲超过该秒数后释放模型，下次请求时透明地重新加载；0 表示常驻
+        self.idle_unload_seconds = idle_unload_seconds
+        self._idle_thread = None
+        self.memory_report = {}
+        self.temperature = 1.0
+        self.current_device = None
+        self.status = STATUS_IDLE
+        self.load_error = None
+        self.timings = {}
+        self._load_lock = threading.Lock()
+        self._rng_lock = threading.Lock()
+        self._warmup_thread = None
+        # 记录推理活动，供预生成等后台任务判断是否空闲
+        self._activity_lock = threading.Lock()
+        self._active_inferences = 0
+        self._last_inference_end = time.monotonic()
+        self.audio_cache = audio_cache if audio_cache is not None else AudioCache()
+        # 生成结果写出前统一做响度归一化、裁剪、淡入淡出和重采样
+        self.postprocessor = postprocessor if postprocessor is not None else AudioPostProcessor()
+        # 同一提示词重复生成（换种子、反馈重生成）时复用文本编码，只跑音频解码器
+        self.text_cache = TextEncodingCache()
+        # 所有会话共享同一个调度器，并发请求会被合并成批
+        self.scheduler = BatchScheduler(self._run_batch)
+        # 进行中的生成按缓存键登记，相同请求同时到达时只生成一次
+        self.inflight = SingleFlight("generate")
+        # 每个会话最近一次生成的音频码本，反馈优化时只重写结尾
+        self.max_refine_sessions = int(os.getenv("MUSIC_REFINE_SESSIONS", "32"))
+        self._session_codes = OrderedDict()
+        self._codes_lock = threading.Lock()
+        self._codes_local = threading.local()
     
-    def load_model(self):
-        """加载音乐生成模型"""
+    @property
+    def model_tag(self):
+        """缓存键中使用的模型标识，不同推理模式或后处理配置的输出不能混用"""
+        tag = self.model_id
+        if self.inference_mode != "fp32" or self.use_compile:
+            tag = f"{tag}@{self.inference_mode}{'+compile' if self.use_compile else ''}"
+        return f"{tag}|{self.postprocessor.tag}"
+    
+    def start_background_load(self):
+        """在后台线程中加载模型并做一次小规模预热推理"""
+        if self._warmup_thread is None:
+            self._warmup_thread = threading.Thread(
+                target=self._background_load, name="musicgen-warmup", daemon=True
+            )
+            self._warmup_thread.start()
+    
+    def _background_load(self):
+        try:
+            self.load_model(mark_ready=False)
+            self.warm_up()
+        except Exception as e:
+            print(f"后台加载模型失败: {e}")
+    
+    def warm_up(self):
+        """用极短的生成预热模型，避免首个用户承担首次推理的初始化开销"""
+        self.status = STATUS_WARMING
+        start = time.perf_counter()
+        before = memory_usage_mb()
+        with self._inference_context():
+            self.pipe("warm up", forward_params={"do_sample": False, "max_new_tokens": 8})
+        self.timings["warmup_seconds"] = time.perf_counter() - start
+        self._report_memory("warm_up", before)
+        self.status = STATUS_READY
+        print(f"模型预热完成，用时 {self.timings['warmup_seconds']:.1f} 秒")
+    
+    def prefetch_prompt(self, prompt):
+        """提前准备即将生成的提示词：模型未加载时开始后台加载，已加载时在后台预先算好文本编码"""
         if not self.model_loaded:
-            print("正在加载MusicGen模型，首次运行需要下载（约2GB）...")
+            self.start_background_load()
+            return
+        # 与生成时同样归一化，预先算好的编码才能被生成命中
+        prompt = self._build_music_prompt({"music_prompt": prompt})
+        threading.Thread(
+            target=self._prefetch_text_encoding, args=(prompt,), name="text-prefetch", daemon=True
+        ).start()
+    
+    def _prefetch_text_encoding(self, prompt):
+        try:
+            with self._model_lease() as model:
+                self._encode_text(model, self._get_processor(), [prompt])
+        except Exception as e:
+            print(f"预先编码提示词失败: {e}")
+    
+    def load_model(self, mark_ready=True):
+        """加载音乐生成模型"""
+        with self._load_lock:
+            if self.model_loaded:
+                return
+            
+            import torch
+            from transformers import pipeline
+            
+            self.current_device = "cuda" if torch.cuda.is_available() else "cpu"
+            print(f"使用设备: {self.current_device}")
+            self.status = STATUS_LOADING
+            start = time.perf_counter()
+            before = memory_usage_mb()
+            try:
+                self.model_source = self._resolve_model_source()
+            except Exception as e:
+                # 离线时本地目录不完整等情况，同样要标记为失败，否则状态一直停在加载中
+                print(f"确定模型来源失败: {e}")
+                self.status = STATUS_FAILED
+                self.load_error = str(e)
+                raise
+            self._report_memory("resolve", before)
+            print(f"正在加载MusicGen模型: {self.model_source}")
+            before = memory_usage_mb()
             try:
-                # 使用优化的配置
+                # 使用优化的配置；low_cpu_mem_usage 跳过随机初始化，直接载入权重
                 self.pipe = pipeline(
                     "text-to-audio", 
-                    model="facebook/musicgen-small",
+                    model=self.model_source,
                     device=-1 if self.current_device == "cpu" else 0,
-                    torch_dtype=torch.float32
+                    torch_dtype=torch.float32,
+                    model_kwargs={"low_cpu_mem_usage": True}
                 )
                 self.model_loaded = True
                 print("模型加载完成！")
@@ -33,70 +237,736 @@ class MusicGenerator:
                 try:
                     self.pipe = pipeline(
                         "text-to-audio", 
-                        model="facebook/musicgen-small"
+                        model=self.model_source
                     )
                     self.model_loaded = True
                     print("模型加载完成（备用方式）！")
                 except Exception as e2:
                     print(f"备用加载也失败: {e2}")
+                    self.status = STATUS_FAILED
+                    self.load_error = str(e2)
                     raise e2
+            
+            self._report_memory("load", before)
+            if self.mmap_weights:
+                before = memory_usage_mb()
+                try:
+                    self._map_shared_weights()
+                except Exception as e:
+                    # 映射失败不影响已加载的权重，只是不共享内存
+                    print(f"权重映射失败，使用私有副本: {e}")
+                gc.collect()
+                _release_free_memory()
+                self._report_memory("map_weights", before)
+            before = memory_usage_mb()
+            self._apply_inference_mode()
+            self._report_memory("inference_mode", before)
+            self.timings["load_seconds"] = time.perf_counter() - start
+            metrics.observe("stage_duration_seconds", self.timings["load_seconds"], stage="model_load")
+            with self._activity_lock:
+                # 空闲计时从加载完成开始，避免刚加载就被回收
+                self._last_inference_end = time.monotonic()
+            if mark_ready:
+                self.status = STATUS_READY
+            self._start_idle_monitor()
+    
+    def _resolve_model_source(self):
+        """确定加载来源：优先固定的本地模型目录，其次本机Hub缓存，都没有时才联网下载"""
+        from huggingface_hub import snapshot_download
+        
+        if self.model_dir:
+            if not os.path.exists(os.path.join(self.model_dir, "config.json")):
+                if self.offline:
+                    raise RuntimeError(f"离线模式下本地模型目录不完整: {self.model_dir}")
+                print(f"首次运行，下载模型到 {self.model_dir}（约2GB）...")
+                snapshot_download(self.model_id, revision=self.model_revision, local_dir=self.model_dir,
+                                  allow_patterns=MODEL_FILE_PATTERNS)
+            return self.model_dir
+        try:
+            return snapshot_download(self.model_id, revision=self.model_revision, local_files_only=True,
+                                     allow_patterns=MODEL_FILE_PATTERNS)
+        except Exception:
+            if self.offline:
+                raise
+            print("本机没有缓存的模型，首次运行需要下载（约2GB）...")
+            return self.model_id
+    
+    def _report_memory(self, step, before):
+        """记录并打印某个步骤前后的内存占用"""
+        after = memory_usage_mb()
+        self.memory_report[step] = {"before": before, "after": after}
+        print(f"内存 [{step}]: {_format_memory(before)} -> {_format_memory(after)}")
+    
+    @contextlib.contextmanager
+    def _model_lease(self):
+        """使用模型期间持有租约：不会被空闲回收，模型已被回收时透明地重新加载"""
+        with self._activity_lock:
+            self._active_inferences += 1
+        try:
+            if not self.model_loaded:
+                self.load_model()
+            yield self.pipe.model
+        finally:
+            self._end_inference()
+    
+    def _start_idle_monitor(self):
+        if self.idle_unload_seconds > 0 and self._idle_thread is None:
+            self._idle_thread = threading.Thread(target=self._idle_monitor, name="model-idle-unload", daemon=True)
+            self._idle_thread.start()
     
-    def generate_music(self, music_specs, duration_seconds=20):
-        """根据音乐描述生成音乐"""
+    def _idle_monitor(self):
+        while True:
+            time.sleep(max(1.0, self.idle_unload_seconds - self.idle_seconds()))
+            try:
+                self.unload_if_idle()
+            except Exception as e:
+                print(f"释放空闲模型失败: {e}")
+    
+    def unload_if_idle(self):
+        """空闲超过 idle_unload_seconds 时释放模型，返回是否已释放"""
+        with self._load_lock, self._activity_lock:
+            if not self.model_loaded or self._active_inferences or self.scheduler.stats()["queued"]:
+                return False
+            idle = time.monotonic() - self._last_inference_end
+            if idle < self.idle_unload_seconds:
+                return False
+            before = memory_usage_mb()
+            self.pipe = None
+            self.model_loaded = False
+            self.status = STATUS_UNLOADED
+            # 允许下一次 prefetch_prompt 重新触发后台加载
+            self._warmup_thread = None
+            gc.collect()
+            _release_free_memory()
+            self._report_memory("unload", before)
+        metrics.inc("model_unloads_total")
+        print(f"模型已空闲 {idle:.0f} 秒，已释放")
+        return True
+    
+    def _weights_file(self):
+        """模型的 safetensors 权重文件路径（本地目录或Hub缓存），找不到时返回None"""
+        source = self.model_source or self.model_id
+        if os.path.isdir(source):
+            path = os.path.join(source, "model.safetensors")
+            return path if os.path.exists(path) else None
+        from huggingface_hub import try_to_load_from_cache
+        path = try_to_load_from_cache(self.model_id, "model.safetensors")
+        return path if isinstance(path, str) else None
+    
+    def _map_shared_weights(self):
+        """把已加载的权重替换为映射自 safetensors 文件的只读张量
+        
+        映射页面由操作系统页缓存提供，多个工作进程加载同一文件时只占一份物理内存，
+        原先私有的权重副本随之释放。
+        """
+        path = self._weights_file()
+        if path is None:
+            print("未找到 safetensors 权重文件，权重不做共享映射")
+            return
+        from safetensors.torch import load_file
+        
+        model = self.pipe.model
+        current = model.state_dict()
+        mapped = load_file(path, device="cpu")
+        # 只替换形状和类型一致的张量，其余（如运行时计算的缓冲区）保持原样
+        matched = {
+            name: tensor for name, tensor in mapped.items()
+            if name in current and current[name].shape == tensor.shape and current[name].dtype == tensor.dtype
+        }
+        del current
+        model.load_state_dict(matched, strict=False, assign=True)
+        model.tie_weights()
+        print(f"权重已映射自 {path}（{len(matched)}/{len(mapped)} 个张量共享）")
+    
+    def _apply_inference_mode(self):
+        """按配置设置线程数、量化和编译"""
+        import torch
+        
+        if self.num_threads:
+            torch.set_num_threads(self.num_threads)
+            try:
+                torch.set_num_interop_threads(1)
+            except RuntimeError:
+                # 只能在首次并行计算前设置，之后忽略
+                pass
+        
+        model = self.pipe.model
+        if self.inference_mode == "int8":
+            # 只量化解码器中的线性层，文本编码器和EnCodec保持fp32
+            model.decoder = torch.ao.quantization.quantize_dynamic(
+                model.decoder, {torch.nn.Linear}, dtype=torch.qint8
+            )
+        
+        if self.use_compile:
+            model.decoder.forward = torch.compile(model.decoder.forward, dynamic=True)
+        
+        print(f"推理模式: {self.inference_mode}，编译: {'开启' if self.use_compile else '关闭'}，"
+              f"线程数: {torch.get_num_threads()}")
+    
+    def _inference_context(self):
+        """推理上下文：关闭梯度，bf16模式下开启CPU自动混合精度"""
+        import contextlib
+        import torch
+        
+        stack = contextlib.ExitStack()
+        stack.enter_context(torch.inference_mode())
+        if self.inference_mode == "bf16":
+            stack.enter_context(torch.autocast("cpu", dtype=torch.bfloat16))
+        with self._activity_lock:
+            self._active_inferences += 1
+        stack.callback(self._end_inference)
+        return stack
+    
+    @contextlib.contextmanager
+    def _sampling(self, seed):
+        """采样区间：持有RNG锁，固定种子时先设种子
+        
+        torch 的随机数生成器是进程全局的，generate 又不接受独立的 Generator；
+        所有采样串行进行，其他线程的推理就不会打乱固定种子请求的随机序列。
+        """
+        with self._rng_lock:
+            if seed is not None:
+                import torch
+                torch.manual_seed(seed)
+            yield
+    
+    def _end_inference(self):
+        with self._activity_lock:
+            self._active_inferences -= 1
+            self._last_inference_end = time.monotonic()
+    
+    def idle_seconds(self):
+        """距上次推理结束的秒数；正在推理或有请求排队时为0"""
+        with self._activity_lock:
+            if self._active_inferences or self.scheduler.stats()["queued"]:
+                return 0.0
+            return time.monotonic() - self._last_inference_end
+    
+    def is_cached(self, music_specs, duration_seconds=20, seed=None):
+        """该描述、时长和种子的结果是否已在音频缓存中；生成失败时的备用音频不会进入缓存
+        
+        超过单窗口的时长按 generate_music 使用的默认分段参数查找。
+        """
+        prompt = self._build_music_prompt(music_specs)
+        max_new_tokens = int(TOKENS_PER_SECOND * duration_seconds)
+        model_tag = self.model_tag
+        if max_new_tokens > MAX_WINDOW_TOKENS:
+            window_tokens = min(TOKENS_PER_SECOND * 20, MAX_WINDOW_TOKENS)
+            model_tag = f"{model_tag}#long:{window_tokens}/{TOKENS_PER_SECOND * 4}"
+        cache_key = self.audio_cache.make_key(
+            prompt, max_new_tokens, self.temperature, seed, model_tag
+        )
+        return self.audio_cache.contains(cache_key)
+    
+    def generate_music(self, music_specs, duration_seconds=20, seed=None, session_id=None, variant=False,
+                       report_fallback=False):
+        """根据音乐描述生成音乐；提供 session_id 时记住本次的音频码本，供 refine_music 复用
+        
+        相同的请求正在生成时挂到进行中的生成上，拿到同一结果的副本；
+        variant=True 时不复用缓存和进行中的相同生成，改用新的随机种子生成一个不同的版本。
+        返回 (文件路径, 提示词)；report_fallback=True 时返回 (文件路径, 提示词, 是否为生成失败时的备用音频)。
+        """
+        # 构建详细的提示词
+        prompt = self._build_music_prompt(music_specs)
+        print(f"生成音乐提示词: {prompt}")
+        if variant:
+            seed = random.randrange(2 ** 31)
+        
+        # 计算合适的token数量（关键修改：增加时长）
+        max_new_tokens = int(TOKENS_PER_SECOND * duration_seconds)
+        
+        # 超过单次推理上限时分段生成，内存只占用一个窗口
+        if max_new_tokens > MAX_WINDOW_TOKENS:
+            return self.generate_long_music(music_specs, duration_seconds, seed=seed,
+                                            report_fallback=report_fallback)
+        
+        # 先查磁盘缓存，命中则无需加载模型
+        cache_key = self.audio_cache.make_key(
+            prompt, max_new_tokens, self.temperature, seed, self.model_tag
+        )
+        cached_file = self.audio_cache.get_copy(cache_key, dir=self.output_dir)
+        if cached_file:
+            print(f"命中音频缓存: {cached_file}")
+            return (cached_file, prompt, False) if report_fallback else (cached_file, prompt)
+        
+        outcome, shared = self.inflight.do(
+            cache_key, self._generate_clip, prompt, max_new_tokens, duration_seconds, seed, cache_key
+        )
+        filename, fallback = outcome["filename"], outcome["fallback"]
+        if shared:
+            filename, fallback = self._shared_copy(cache_key, filename, fallback, duration_seconds)
+        if session_id is not None and outcome["codes"] is not None and not fallback:
+            self._remember_codes(session_id, outcome["codes"], filename)
+        return (filename, outcome["prompt"], fallback) if report_fallback else (filename, outcome["prompt"])
+    
+    def _shared_copy(self, cache_key, filename, fallback, duration_seconds):
+        """合并到进行中的生成后取一份自己的副本，返回 (文件路径, 是否为备用音频)
+        
+        进行中的结果归发起者所有：优先从缓存复制；缓存未写入（已关闭、写入失败或已淘汰）时复制发起者的文件。
+        """
+        if not fallback:
+            copied = self.audio_cache.get_copy(cache_key, dir=self.output_dir)
+            if copied is None:
+                try:
+                    copied = self._new_output_file(os.path.splitext(filename)[1])
+                    shutil.copyfile(filename, copied)
+                except OSError as e:
+                    # 发起者已把文件移走或删除
+                    print(f"复制进行中生成的结果失败: {e}")
+                    copied = None
+            if copied is not None:
+                print(f"合并到进行中的相同生成: {copied}")
+                return copied, False
+        return self._create_fallback_audio(duration_seconds), True
+    
+    def _generate_clip(self, prompt, max_new_tokens, duration_seconds, seed, cache_key):
+        """生成单窗口音频并写入缓存，返回 {"filename", "prompt", "codes", "fallback"}"""
         if not self.model_loaded:
             self.load_model()
         
         try:
-            # 构建详细的提示词
-            prompt = self._build_music_prompt(music_specs)
-            print(f"生成音乐提示词: {prompt}")
-            
-            # 计算合适的token数量（关键修改：增加时长）
-            tokens_per_second = 50  # MusicGen的经验值
-            max_new_tokens = int(tokens_per_second * duration_seconds)
-            
-            # 安全限制，避免内存溢出
-            max_new_tokens = min(max_new_tokens, 1500)  # 最多30秒
-            
             print(f"生成 {duration_seconds} 秒音乐，使用 {max_new_tokens} tokens")
             
-            # 生成音乐
+            # 生成音乐（经由微批调度器，与其他会话的请求合并推理）
             print("正在生成音乐，请耐心等待...")
-            result = self.pipe(
-                prompt,
-                forward_params={
-                    "do_sample": True,
-                    "max_new_tokens": max_new_tokens,
-                    "temperature": 1.0  # 增加创造性
-                }
+            result = self.scheduler.generate(
+                prompt, max_new_tokens, temperature=self.temperature, seed=seed
             )
             
             # 使用临时文件避免存储问题
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as tmp_file:
-                filename = tmp_file.name
-            
-            # 保存音频文件
-            scipy.io.wavfile.write(
-                filename, 
-                rate=result["sampling_rate"], 
-                data=result["audio"][0]
-            )
+            filename = self._new_output_file()
+            
+            # 后处理并保存音频文件
+            with metrics.span("postprocess"):
+                info = self.postprocessor.process(
+                    array_source(result["audio"][0]), result["sampling_rate"], filename
+                )
             
             # 验证文件时长
-            actual_duration = len(result["audio"][0]) / result["sampling_rate"]
+            actual_duration = info["samples"] / info["sampling_rate"]
             print(f"音乐生成完成: {filename}, 实际时长: {actual_duration:.1f}秒")
             
-            return filename, prompt
+            # 写入缓存，失败不影响本次结果
+            try:
+                self.audio_cache.put(cache_key, filename)
+            except OSError as cache_error:
+                print(f"写入音频缓存失败: {cache_error}")
+            
+            return {"filename": filename, "prompt": prompt, "codes": result.get("audio_codes"), "fallback": False}
             
         except Exception as e:
             print(f"生成音乐时出错: {e}")
+            metrics.inc("errors_total", stage="generate")
+            metrics.inc("fallbacks_total", source="generate")
             # 创建一个简单的备用音频文件
-            return self._create_fallback_audio(duration_seconds), f"生成失败，使用备用音频: {str(e)}"
+            return {
+                "filename": self._create_fallback_audio(duration_seconds),
+                "prompt": f"生成失败，使用备用音频: {str(e)}",
+                "codes": None,
+                "fallback": True,
+            }
+    
+    def generate_long_music(self, music_specs, duration_seconds, window_seconds=20,
+                            overlap_seconds=4, seed=None, report_fallback=False):
+        """分段生成长音乐：每段以前一段结尾为音频条件续写，段间做等功率交叉淡化
+        
+        相同的请求正在生成时挂到进行中的生成上，拿到同一结果的副本。
+        """
+        prompt = self._build_music_prompt(music_specs)
+        total_tokens = int(TOKENS_PER_SECOND * duration_seconds)
+        window_tokens = min(int(TOKENS_PER_SECOND * window_seconds), MAX_WINDOW_TOKENS)
+        overlap_tokens = int(TOKENS_PER_SECOND * overlap_seconds)
+        if overlap_tokens >= window_tokens:
+            raise ValueError("overlap_seconds 必须小于 window_seconds")
+        
+        cache_key = self.audio_cache.make_key(
+            prompt, total_tokens, self.temperature, seed,
+            f"{self.model_tag}#long:{window_tokens}/{overlap_tokens}"
+        )
+        cached_file = self.audio_cache.get_copy(cache_key, dir=self.output_dir)
+        if cached_file:
+            print(f"命中音频缓存: {cached_file}")
+            return (cached_file, prompt, False) if report_fallback else (cached_file, prompt)
+        
+        (filename, prompt_used, fallback), shared = self.inflight.do(
+            cache_key, self._generate_long, prompt, duration_seconds, window_seconds, overlap_seconds,
+            total_tokens, window_tokens, overlap_tokens, seed, cache_key
+        )
+        if shared:
+            filename, fallback = self._shared_copy(cache_key, filename, fallback, duration_seconds)
+        return (filename, prompt_used, fallback) if report_fallback else (filename, prompt_used)
+    
+    def _generate_long(self, prompt, duration_seconds, window_seconds, overlap_seconds,
+                       total_tokens, window_tokens, overlap_tokens, seed, cache_key):
+        """分段生成并写入缓存，返回 (文件路径, 提示词, 是否为备用音频)；失败时返回备用音频"""
+        if not self.model_loaded:
+            self.load_model()
+        
+        try:
+            print(f"分段生成 {duration_seconds} 秒长音乐，窗口 {window_seconds} 秒，重叠 {overlap_seconds} 秒")
+            filename = self._new_output_file()
+            
+            # 逐段写入文件，内存中只保留尚未写出的重叠部分
+            out = None
+            try:
+                for chunk, sampling_rate in self._iter_windows(prompt, total_tokens, window_tokens, overlap_tokens, seed):
+                    if out is None:
+                        out = sf.SoundFile(filename, "w", samplerate=sampling_rate, channels=1, subtype="PCM_16")
+                    out.write(chunk)
+            finally:
+                if out is not None:
+                    out.close()
+            
+            with metrics.span("postprocess"):
+                self.postprocessor.process_file(filename)
+            print(f"长音乐生成完成: {filename}")
+            
+            try:
+                self.audio_cache.put(cache_key, filename)
+            except OSError as cache_error:
+                print(f"写入音频缓存失败: {cache_error}")
+            
+            return filename, prompt, False
+            
+        except Exception as e:
+            print(f"生成长音乐时出错: {e}")
+            metrics.inc("errors_total", stage="generate_long")
+            metrics.inc("fallbacks_total", source="generate_long")
+            return self._create_fallback_audio(duration_seconds), f"生成失败，使用备用音频: {str(e)}", True
+    
+    def refine_music(self, music_specs, duration_seconds=20, session_id=None, previous_file=None,
+                     tail_seconds=None, seed=None):
+        """按新的描述只重写上一段音乐的结尾：保留前段作为音频条件，续写结尾部分
+        
+        优先复用该会话记住的音频码本；上一段来自缓存、流式生成或预设时，对其前段音频重新编码。
+        没有可用的上一段（或超过单窗口时长）时退化为完整生成。
+        """
+        prompt = self._build_music_prompt(music_specs)
+        total_tokens = int(TOKENS_PER_SECOND * duration_seconds)
+        if tail_seconds is None:
+            tail_seconds = duration_seconds * float(os.getenv("MUSIC_REFINE_TAIL_RATIO", "0.5"))
+        tail_tokens = min(total_tokens, max(1, int(TOKENS_PER_SECOND * tail_seconds)))
+        keep_tokens = total_tokens - tail_tokens
+        if total_tokens > MAX_WINDOW_TOKENS or keep_tokens <= 0 or not previous_file:
+            return self.generate_music(music_specs, duration_seconds, seed=seed, session_id=session_id)
+        
+        try:
+            import torch
+            
+            with self._model_lease() as model:
+                processor = self._get_processor()
+                sampling_rate = model.config.audio_encoder.sampling_rate
+                inputs = self._encode_text(model, processor, [prompt])
+                
+                with self._codes_lock:
+                    entry = self._session_codes.get(session_id)
+                if (entry is not None and entry["basename"] == os.path.basename(previous_file)
+                        and entry["codes"].shape[-1] >= keep_tokens):
+                    # 直接以上一次的码本前段作为解码器输入，无需重新编码音频
+                    inputs["decoder_input_ids"] = entry["codes"][:, :keep_tokens].to(model.device)
+                    source = "codes"
+                else:
+                    keep_seconds = keep_tokens / TOKENS_PER_SECOND
+                    with sf.SoundFile(previous_file) as f:
+                        file_rate = f.samplerate
+                        prefix = f.read(int(keep_seconds * file_rate), dtype="float32", always_2d=True)[:, 0]
+                    if file_rate != sampling_rate:
+                        # 后处理输出的采样率与模型不同，重采样回模型采样率作为条件
+                        from scipy.signal import resample_poly
+                        prefix = resample_poly(prefix, sampling_rate, file_rate).astype(np.float32)
+                    audio_inputs = processor(
+                        audio=prefix,
+                        sampling_rate=sampling_rate,
+                        return_tensors="pt"
+                    ).to(model.device)
+                    inputs["input_values"] = audio_inputs["input_values"]
+                    if "padding_mask" in audio_inputs:
+                        inputs["padding_mask"] = audio_inputs["padding_mask"]
+                    source = "audio"
+                
+                print(f"增量优化：保留前 {keep_tokens / TOKENS_PER_SECOND:.1f} 秒，"
+                      f"重写后 {tail_tokens / TOKENS_PER_SECOND:.1f} 秒（条件来源: {source}）")
+                self._install_code_capture(model)
+                self._codes_local.codes = None
+                start = time.perf_counter()
+                with metrics.span("inference"), self._inference_context(), self._sampling(seed):
+                    audio_values = model.generate(
+                        **inputs,
+                        do_sample=True,
+                        max_new_tokens=tail_tokens,
+                        temperature=self.temperature
+                    )
+                inference_seconds = time.perf_counter() - start
+                metrics.observe("real_time_factor", inference_seconds / (tail_tokens / TOKENS_PER_SECOND),
+                                buckets=metrics.RTF_BUCKETS)
+                metrics.inc("refinements_total", source=source)
+                
+                with metrics.span("decode"):
+                    waveform = audio_values[0, 0].cpu().float().numpy()
+                filename = self._new_output_file()
+                with metrics.span("postprocess"):
+                    self.postprocessor.process(array_source(waveform), sampling_rate, filename)
+                
+                codes = self._codes_local.codes
+                if session_id is not None and codes is not None:
+                    self._remember_codes(session_id, codes[0, 0].cpu(), filename)
+                print(f"增量优化完成: {filename}, 用时 {inference_seconds:.1f} 秒")
+                return filename, prompt
+        
+        except Exception as e:
+            print(f"增量优化失败，改为完整生成: {e}")
+            metrics.inc("fallbacks_total", source="refine")
+            return self.generate_music(music_specs, duration_seconds, seed=seed, session_id=session_id)
+    
+    def _remember_codes(self, session_id, codes, filename):
+        """记住会话最近一次生成的码本（num_codebooks, 帧数），按文件名校验是否仍是当前音频"""
+        with self._codes_lock:
+            self._session_codes[session_id] = {"codes": codes, "basename": os.path.basename(filename)}
+            self._session_codes.move_to_end(session_id)
+            while len(self._session_codes) > self.max_refine_sessions:
+                self._session_codes.popitem(last=False)
+    
+    def _install_code_capture(self, model):
+        """包装音频解码器的 decode，在当前线程记下 generate 最终解码的码本"""
+        audio_encoder = getattr(model, "audio_encoder", None)
+        if audio_encoder is None or getattr(audio_encoder, "_captures_codes", False):
+            return
+        decode = audio_encoder.decode
+        local = self._codes_local
+        
+        def decode_and_capture(audio_codes, *args, **kwargs):
+            local.codes = audio_codes
+            return decode(audio_codes, *args, **kwargs)
+        
+        audio_encoder.decode = decode_and_capture
+        audio_encoder._captures_codes = True
+    
+    def stream_music(self, music_specs, duration_seconds=20, block_seconds=5,
+                     overlap_seconds=1, seed=None):
+        """流式生成音乐：每解码完一段就产出一段音频，同时追加写入WAV文件
+        
+        每次产出 {"audio", "sampling_rate", "filename", "prompt", "complete"}，filename 中始终是目前已产出的全部音频；
+        命中缓存时只产出一次完整音频，complete 为True。
+        相同的请求正在流式生成时等它完成，从缓存取副本一次性产出。
+        """
+        prompt = self._build_music_prompt(music_specs)
+        total_tokens = int(TOKENS_PER_SECOND * duration_seconds)
+        overlap_tokens = int(TOKENS_PER_SECOND * overlap_seconds)
+        window_tokens = min(int(TOKENS_PER_SECOND * block_seconds) + overlap_tokens, MAX_WINDOW_TOKENS)
+        
+        cache_key = self.audio_cache.make_key(
+            prompt, total_tokens, self.temperature, seed,
+            f"{self.model_tag}#stream:{window_tokens}/{overlap_tokens}"
+        )
+        while True:
+            cached_file = self.audio_cache.get_copy(cache_key, dir=self.output_dir)
+            if cached_file:
+                print(f"命中音频缓存: {cached_file}")
+                audio, sampling_rate = sf.read(cached_file, dtype="float32")
+                yield {"audio": audio, "sampling_rate": sampling_rate, "filename": cached_file, "prompt": prompt,
+                       "complete": True}
+                return
+            future, leader = self.inflight.join(cache_key)
+            if leader:
+                break
+            # 等进行中的相同生成结束后再查缓存；它失败或被中途放弃时由本调用接手生成
+            print("等待进行中的相同流式生成")
+            future.result()
+        
+        try:
+            if not self.model_loaded:
+                self.load_model()
+            
+            print(f"流式生成 {duration_seconds} 秒音乐，每段 {block_seconds} 秒")
+            filename = self._new_output_file()
+            
+            out = None
+            try:
+                for chunk, sampling_rate in self._iter_windows(prompt, total_tokens, window_tokens, overlap_tokens, seed):
+                    if out is None:
+                        out = sf.SoundFile(filename, "w", samplerate=sampling_rate, channels=1, subtype="PCM_16")
+                    out.write(chunk)
+                    out.flush()
+                    yield {"audio": chunk, "sampling_rate": sampling_rate, "filename": filename, "prompt": prompt,
+                           "complete": False}
+            finally:
+                if out is not None:
+                    out.close()
+            
+            # 响度归一化需要整段音频，流式播放的各段保持原样，最终文件在全部产出后再做后处理
+            with metrics.span("postprocess"):
+                self.postprocessor.process_file(filename)
+            print(f"流式生成完成: {filename}")
+            try:
+                self.audio_cache.put(cache_key, filename)
+            except OSError as cache_error:
+                print(f"写入音频缓存失败: {cache_error}")
+        finally:
+            self.inflight.finish(cache_key)
+    
+    def _iter_windows(self, prompt, total_tokens, window_tokens, overlap_tokens, seed=None):
+        """按窗口续写生成，依次产出已完成交叉淡化、可以直接播放或写出的音频块
+        
+        固定种子时第 i 个窗口使用 seed + i，结果不受窗口之间其他线程推理的影响。
+        """
+        with self._model_lease() as model:
+            processor = self._get_processor()
+            sampling_rate = model.config.audio_encoder.sampling_rate
+            overlap_samples = overlap_tokens * (sampling_rate // TOKENS_PER_SECOND)
+            
+            pending = None
+            generated_tokens = 0
+            window_index = 0
+            while generated_tokens < total_tokens:
+                # 第一段生成完整窗口，之后每段在重叠部分之外生成新内容
+                step_tokens = window_tokens if pending is None else window_tokens - overlap_tokens
+                step_tokens = min(step_tokens, total_tokens - generated_tokens)
+                window_seed = None if seed is None else seed + window_index
+                window_index += 1
+                chunk = self._generate_window(model, processor, prompt, pending, sampling_rate, step_tokens,
+                                              window_seed)
+                generated_tokens += step_tokens
+                print(f"已生成 {generated_tokens / TOKENS_PER_SECOND:.0f}/{total_tokens / TOKENS_PER_SECOND:.0f} 秒")
+            
+                if pending is not None:
+                    # 输出开头是对条件音频的重建，与上一段结尾交叉淡化
+                    n = min(len(pending), len(chunk))
+                    chunk = np.concatenate([equal_power_crossfade(pending[-n:], chunk[:n]), chunk[n:]])
+            
+                if generated_tokens >= total_tokens:
+                    yield chunk, sampling_rate
+                    break
+                if overlap_samples and len(chunk) > overlap_samples:
+                    pending = chunk[-overlap_samples:]
+                    yield chunk[:-overlap_samples], sampling_rate
+                else:
+                    # 不重叠时下一段不带音频条件，从头生成完整窗口
+                    pending = None
+                    yield chunk, sampling_rate
+    
+    def _generate_window(self, model, processor, prompt, audio_prompt, sampling_rate, max_new_tokens, seed=None):
+        """生成一个窗口；提供 audio_prompt 时输出包含对它的重建"""
+        inputs = self._encode_text(model, processor, [prompt])
+        if audio_prompt is not None:
+            audio_inputs = processor(
+                audio=audio_prompt,
+                sampling_rate=sampling_rate,
+                return_tensors="pt"
+            ).to(model.device)
+            inputs["input_values"] = audio_inputs["input_values"]
+            if "padding_mask" in audio_inputs:
+                inputs["padding_mask"] = audio_inputs["padding_mask"]
+        
+        start = time.perf_counter()
+        with metrics.span("inference"), self._inference_context(), self._sampling(seed):
+            audio_values = model.generate(
+                **inputs,
+                do_sample=True,
+                max_new_tokens=max_new_tokens,
+                temperature=self.temperature
+            )
+        inference_seconds = time.perf_counter() - start
+        
+        with metrics.span("decode"):
+            waveform = audio_values[0, 0].cpu().float().numpy()
+        # 续写窗口的输出包含条件音频的重建，只按新生成部分计算实时率
+        new_seconds = max_new_tokens / TOKENS_PER_SECOND
+        metrics.observe("real_time_factor", inference_seconds / new_seconds, buckets=metrics.RTF_BUCKETS)
+        return waveform
+    
+    def _encode_text(self, model, processor, prompts):
+        """取得一批提示词的文本条件（命中缓存则跳过文本编码器），返回可直接传给 generate 的参数"""
+        import torch
+        import torch.nn.functional as F
+        from transformers.modeling_outputs import BaseModelOutput
+        
+        entries = []
+        for prompt in prompts:
+            entry = self.text_cache.get(prompt)
+            if entry is None:
+                tokens = processor(text=[prompt], padding=True, return_tensors="pt").to(model.device)
+                with metrics.span("text_encode"), self._inference_context():
+                    hidden_states = model.text_encoder(
+                        input_ids=tokens["input_ids"],
+                        attention_mask=tokens["attention_mask"]
+                    ).last_hidden_state
+                entry = (tokens["input_ids"][0], tokens["attention_mask"][0], hidden_states[0])
+                self.text_cache.put(prompt, entry)
+            entries.append(entry)
+        
+        # 批内按最长提示词右侧补齐，补齐位置由 attention_mask 屏蔽
+        max_len = max(len(input_ids) for input_ids, _, _ in entries)
+        pad_token_id = processor.tokenizer.pad_token_id or 0
+        input_ids = torch.stack([
+            F.pad(ids, (0, max_len - len(ids)), value=pad_token_id) for ids, _, _ in entries
+        ])
+        attention_mask = torch.stack([
+            F.pad(mask, (0, max_len - len(mask)), value=0) for _, mask, _ in entries
+        ])
+        hidden_states = torch.stack([
+            F.pad(hidden, (0, 0, 0, max_len - len(hidden))) for _, _, hidden in entries
+        ])
+        
+        # 与 generate 内部一致：无分类器引导需要拼接一份空条件
+        guidance_scale = model.generation_config.guidance_scale
+        if guidance_scale is not None and guidance_scale > 1:
+            hidden_states = torch.cat([hidden_states, torch.zeros_like(hidden_states)], dim=0)
+            attention_mask = torch.cat([attention_mask, torch.zeros_like(attention_mask)], dim=0)
+        
+        return {
+            "input_ids": input_ids,
+            "attention_mask": attention_mask,
+            "encoder_outputs": BaseModelOutput(last_hidden_state=hidden_states),
+        }
+    
+    def _get_processor(self):
+        """按需加载MusicGen处理器（文本分词 + 音频特征提取）"""
+        if self.processor is None:
+            from transformers import AutoProcessor
+            self.processor = AutoProcessor.from_pretrained(self.model_source or self.model_id)
+        return self.processor
+    
+    def _run_batch(self, prompts, max_new_tokens, temperature, seed):
+        """对一组参数相同的提示词做一次批量推理，返回与单条调用格式一致的结果列表"""
+        with self._model_lease() as model:
+            inputs = self._encode_text(model, self._get_processor(), prompts)
+            self._install_code_capture(model)
+            self._codes_local.codes = None
+            start = time.perf_counter()
+            with metrics.span("inference"), self._inference_context(), self._sampling(seed):
+                audio_values = model.generate(
+                    **inputs,
+                    do_sample=True,
+                    max_new_tokens=max_new_tokens,
+                    temperature=temperature  # 增加创造性
+                )
+            inference_seconds = time.perf_counter() - start
+            codes = self._codes_local.codes
+            
+            sampling_rate = model.config.audio_encoder.sampling_rate
+            results = []
+            with metrics.span("decode"):
+                for index, waveform in enumerate(audio_values):
+                    # 统一成 (1, 采样点) 形状，保证 result["audio"][0] 是波形
+                    result = {
+                        "audio": waveform.cpu().float().numpy().reshape(1, -1),
+                        "sampling_rate": sampling_rate,
+                    }
+                    if codes is not None:
+                        result["audio_codes"] = codes[0, index].cpu()
+                    results.append(result)
+            
+            # 一批共享一次推理，实时率按整批音频总时长计算
+            audio_seconds = sum(r["audio"].shape[-1] for r in results) / sampling_rate
+            if audio_seconds:
+                metrics.observe("real_time_factor", inference_seconds / audio_seconds, buckets=metrics.RTF_BUCKETS)
+            return results
     
     def _build_music_prompt(self, music_specs):
         """构建音乐生成提示词"""
         if "music_prompt" in music_specs and music_specs["music_prompt"]:
-            return music_specs["music_prompt"]
+            # 折叠空白，只有空白差异的提示词共用缓存和进行中的生成
+            return " ".join(music_specs["music_prompt"].split())
         
         # 如果没有提供详细提示词，根据其他信息构建
         style = music_specs.get("style", "")
@@ -120,44 +990,33 @@ class MusicGenerator:
             return "创作一段优美的背景音乐"
     
     def _create_fallback_audio(self, duration_seconds=10):
-        """创建备用的简单音频文件（如果生成失败）"""
-        sampling_rate = 44100
-        duration_samples = int(duration_seconds * sampling_rate)
-        
-        # 生成简单的和弦进行
-        t = np.linspace(0, duration_seconds, duration_samples, False)
-        
-        # 创建C大调和弦 (C, E, G)
-        freq_c = 261.63  # C4
-        freq_e = 329.63  # E4  
-        freq_g = 392.00  # G4
-        
-        # 生成三个频率的正弦波
-        note_c = 0.3 * np.sin(2 * np.pi * freq_c * t)
-        note_e = 0.2 * np.sin(2 * np.pi * freq_e * t)
-        note_g = 0.2 * np.sin(2 * np.pi * freq_g * t)
-        
-        # 合并音符并添加简单的包络
-        audio = note_c + note_e + note_g
-        envelope = np.ones_like(audio)
-        
-        # 添加淡入淡出
-        fade_samples = int(0.1 * sampling_rate)  # 100ms淡入淡出
-        envelope[:fade_samples] = np.linspace(0, 1, fade_samples)
-        envelope[-fade_samples:] = np.linspace(1, 0, fade_samples)
-        
-        audio = audio * envelope
-        
-        # 转换为16位PCM格式
-        audio = np.int16(audio * 32767)
-        
-        # 保存为WAV文件
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as tmp_file:
-            filename = tmp_file.name
-        
-        scipy.io.wavfile.write(filename, sampling_rate, audio)
+        """创建备用的简单音频文件（如果生成失败）：逐块合成C大调和弦，经同一后处理写出"""
+        sampling_rate = self.postprocessor.target_rate or 44100
+        filename = self._new_output_file()
+        # 和弦直接按输出采样率合成，无需重采样；保留原来的 100ms 淡入淡出
+        self.postprocessor.process(
+            lambda: chord_blocks(duration_seconds, sampling_rate, self.postprocessor.block_size),
+            sampling_rate, filename, fade_in_ms=100, fade_out_ms=100
+        )
         return filename
     
-    def cleanup_temp_files(self):
-        """清理临时文件（可选）"""
-        pass  # 使用tempfile会自动清理
\ No newline at end of file
+    def _new_output_file(self, suffix=".wav"):
+        """在输出目录中创建一个新的音频文件路径"""
+        with tempfile.NamedTemporaryFile(delete=False, suffix=suffix, dir=self.output_dir) as tmp_file:
+            return tmp_file.name
+    
+    def cleanup_temp_files(self, max_age_seconds=3600):
+        """清理输出目录中长时间未被认领的音频文件"""
+        if not self.output_dir:
+            return 0
+        removed = 0
+        now = time.time()
+        for name in os.listdir(self.output_dir):
+            path = os.path.join(self.output_dir, name)
+            try:
+                if name.endswith(".wav") and now - os.stat(path).st_mtime > max_age_seconds:
+                    os.remove(path)
+                    removed += 1
+            except FileNotFoundError:
+                continue
+        return removed
\ No newline at end of file
@@ -0,0 +1,209 @@
+"""示例预设的预生成音频库
+
+页面上的四个示例按钮占了大部分请求。这里为每个预设预先渲染若干个不同种子的版本
+（离线运行本模块，或在生成器空闲时后台渲染），点击时直接从音频缓存交付，
+被取走的版本在后台补齐，多次点击同一预设会轮换不同版本。
+
+离线预生成：python -m preset_library --variants 3 --duration 20
+"""
+import os
+import time
+import argparse
+import tempfile
+import threading
+from collections import deque
+
+# 预设名称 -> 对应的用户描述（与页面示例按钮一致）
+PRESETS = {
+    "游戏配乐": "电子游戏背景音乐，欢快活泼，有电子合成器和鼓点",
+    "悲伤钢琴": "悲伤的钢琴曲，缓慢的节奏，表达失落的情感",
+    "中国古风": "中国古风音乐，使用古筝和笛子，优雅传统",
+    "激昂战斗": "激昂的战斗配乐，强烈的节奏，使用管弦乐和打击乐",
+}
+
+# 启动时在这个种子范围内查找已渲染好的版本（包括离线预生成的）
+RECOVER_SEED_FACTOR = 4
+
+
+class PresetLibrary:
+    """按预设维护已渲染版本的种子队列；音频本身存放在生成器的音频缓存中"""
+
+    def __init__(self, generator, analyze, variants=None, duration_seconds=None, idle_seconds=None):
+        if variants is None:
+            variants = int(os.getenv("MUSIC_PRESET_VARIANTS", "3"))
+        if duration_seconds is None:
+            duration_seconds = int(os.getenv("MUSIC_PRESET_DURATION", "20"))
+        if idle_seconds is None:
+            idle_seconds = float(os.getenv("MUSIC_PRESET_IDLE_SECONDS", "30"))
+        self.generator = generator
+        self.analyze = analyze
+        self.variants = variants
+        self.duration_seconds = duration_seconds
+        self.idle_seconds = idle_seconds
+        self.hits = 0
+        self.misses = 0
+        self.rendered = 0
+        self._specs = {}
+        self._fresh = {name: deque() for name in PRESETS}
+        self._served = {name: deque(maxlen=variants) for name in PRESETS}
+        self._next_seed = {name: 0 for name in PRESETS}
+        self._by_input = {text: name for name, text in PRESETS.items()}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._recovered = False
+
+    def specs(self, name):
+        """预设对应的音乐需求（只分析一次）"""
+        if name not in self._specs:
+            self._specs[name] = self.analyze(PRESETS[name])
+        return dict(self._specs[name])
+
+    def _recover(self):
+        """找回音频缓存中已有的版本，避免重启后重复渲染"""
+        if self._recovered:
+            return
+        for name in PRESETS:
+            specs = self.specs(name)
+            for seed in range(self.variants * RECOVER_SEED_FACTOR):
+                if self.generator.is_cached(specs, self.duration_seconds, seed):
+                    if len(self._fresh[name]) < self.variants:
+                        self._fresh[name].append(seed)
+                    self._next_seed[name] = seed + 1
+        self._recovered = True
+
+    def take(self, user_input, duration_seconds):
+        """预设命中时返回 (音乐需求, 文件路径, 提示词)，否则返回None
+
+        优先交付未播放过的版本；都播放过时轮换已播放过的版本，同时唤醒后台补齐。
+        """
+        name = self._by_input.get(user_input)
+        if name is None or duration_seconds != self.duration_seconds:
+            return None
+        specs = self.specs(name)
+        with self._lock:
+            self._recover()
+            seed = None
+            while self._fresh[name]:
+                candidate = self._fresh[name].popleft()
+                if self.generator.is_cached(specs, self.duration_seconds, candidate):
+                    seed = candidate
+                    break
+            if seed is None and self._served[name]:
+                self._served[name].rotate(-1)
+                candidate = self._served[name][-1]
+                if self.generator.is_cached(specs, self.duration_seconds, candidate):
+                    seed = candidate
+            if seed is None:
+                self.misses += 1
+                self._wake.set()
+                return None
+            if seed not in self._served[name]:
+                self._served[name].append(seed)
+            self.hits += 1
+        self._wake.set()
+
+        filename, prompt = self.generator.generate_music(specs, self.duration_seconds, seed=seed)
+        return specs, filename, prompt
+
+    def _most_needed(self):
+        """返回待补齐版本最多的预设，全部补齐时返回None"""
+        with self._lock:
+            name = min(PRESETS, key=lambda n: len(self._fresh[n]))
+            if len(self._fresh[name]) >= self.variants:
+                return None
+            seed = self._next_seed[name]
+            self._next_seed[name] += 1
+            return name, seed
+
+    def render_one(self):
+        """渲染一个缺少的版本，全部补齐时返回False"""
+        with self._lock:
+            self._recover()
+        needed = self._most_needed()
+        if needed is None:
+            return False
+        name, seed = needed
+        specs = self.specs(name)
+        filename, _ = self.generator.generate_music(specs, self.duration_seconds, seed=seed)
+        # 结果已进入音频缓存，这份副本不再需要
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+        if not self.generator.is_cached(specs, self.duration_seconds, seed):
+            # 生成失败时拿到的是备用音频，不会进入缓存
+            raise RuntimeError(f"预设「{name}」版本 {seed} 生成失败")
+        with self._lock:
+            self._fresh[name].append(seed)
+        self.rendered += 1
+        print(f"预设「{name}」版本 {seed} 已就绪")
+        return True
+
+    def render_all(self):
+        """同步渲染到每个预设都有足够的版本（离线预生成用）"""
+        while self.render_one():
+            pass
+
+    def start(self):
+        """启动后台补齐线程：只在生成器空闲足够久时渲染"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._refill_loop, name="preset-refill", daemon=True)
+            self._thread.start()
+
+    def _refill_loop(self):
+        while True:
+            self._wake.wait(timeout=5)
+            self._wake.clear()
+            while self.generator.model_loaded:
+                # 有真实请求时让路，空闲足够久才做预生成
+                idle = self.generator.idle_seconds()
+                if idle < self.idle_seconds:
+                    time.sleep(self.idle_seconds - idle)
+                    continue
+                try:
+                    if not self.render_one():
+                        break
+                except Exception as e:
+                    print(f"预设预生成失败: {e}")
+                    time.sleep(self.idle_seconds)
+                    break
+
+    def stats(self):
+        """返回预设库概况"""
+        with self._lock:
+            return {
+                "ready": sum(len(seeds) for seeds in self._fresh.values()),
+                "target": self.variants * len(PRESETS),
+                "hits": self.hits,
+                "misses": self.misses,
+                "rendered": self.rendered,
+            }
+
+
+def main():
+    from music_generator import MusicGenerator
+    from zhipu_client import ZhipuClient
+
+    parser = argparse.ArgumentParser(description="离线预生成示例预设的音频版本")
+    parser.add_argument("--variants", type=int, default=None, help="每个预设的版本数")
+    parser.add_argument("--duration", type=int, default=None, help="每个版本的时长（秒）")
+    args = parser.parse_args()
+
+    # 渲染结果只进音频缓存，中间文件放在单独的目录里，结束时统一清掉
+    generator = MusicGenerator(output_dir=tempfile.mkdtemp(prefix="presets-", dir=os.getenv("MUSIC_OUTPUT_DIR")))
+    library = PresetLibrary(generator, ZhipuClient().analyze_music_request,
+                            variants=args.variants, duration_seconds=args.duration)
+    start = time.perf_counter()
+    try:
+        library.render_all()
+    finally:
+        generator.cleanup_temp_files(max_age_seconds=0)
+        os.rmdir(generator.output_dir)
+    stats = library.stats()
+    print(f"预生成完成：新渲染 {stats['rendered']} 个，就绪 {stats['ready']}/{stats['target']}，"
+          f"用时 {time.perf_counter() - start:.1f} 秒")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+import threading
+from concurrent.futures import Future
+import metrics
+
+
+class SingleFlight:
+    """进行中请求登记表：同一个键的并发调用只执行一次，后到者挂到进行中的调用上等待同一结果
+
+    与缓存互补：缓存只对已完成的结果生效，这里覆盖结果产出之前的那段时间（如大家同时点同一个预设）。
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.executed = 0
+        self.coalesced = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def join(self, key):
+        """给无法包成一次函数调用的场合（如边生成边产出的生成器）登记：返回 (Future, 是否为发起者)
+
+        发起者结束时（无论成败）必须调用 finish，等待者随后从缓存取结果，取不到时自行处理。
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            if future is None:
+                future = self._calls[key] = Future()
+                self.executed += 1
+                return future, True
+            self.coalesced += 1
+        metrics.inc("inflight_coalesced_total", kind=self.name)
+        return future, False
+
+    def finish(self, key):
+        """注销 join 登记的调用并唤醒等待者"""
+        with self._lock:
+            future = self._calls.pop(key)
+        future.set_result(None)
+
+    def do(self, key, fn, *args, **kwargs):
+        """执行 fn 或等待进行中的同键调用，返回 (结果, 是否为共享结果)；异常同样共享"""
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._calls[key] = future
+                self.executed += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            metrics.inc("inflight_coalesced_total", kind=self.name)
+            return future.result(), True
+
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            # 结果交给等待者后即注销，之后的请求由缓存接手
+            with self._lock:
+                del self._calls[key]
+
+    def stats(self):
+        """返回合并统计"""
+        with self._lock:
+            total = self.executed + self.coalesced
+            return {
+                "executed": self.executed,
+                "coalesced": self.coalesced,
+                "in_flight": len(self._calls),
+                "coalesce_rate": self.coalesced / total if total else 0.0,
+            }
@@ -0,0 +1,52 @@
+import os
+import threading
+from collections import OrderedDict
+import metrics
+
+
+class TextEncodingCache:
+    """文本条件编码缓存：按提示词缓存文本编码器输出，LRU淘汰"""
+
+    def __init__(self, max_entries=None):
+        if max_entries is None:
+            max_entries = int(os.getenv("MUSIC_TEXT_CACHE_SIZE", "64"))
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, prompt):
+        """返回缓存的 (input_ids, attention_mask, hidden_states)，未命中返回None"""
+        with self._lock:
+            entry = self._entries.get(prompt)
+            if entry is None:
+                self.misses += 1
+                metrics.inc("cache_requests_total", cache="text_encoding", result="miss")
+                return None
+            self._entries.move_to_end(prompt)
+            self.hits += 1
+            metrics.inc("cache_requests_total", cache="text_encoding", result="hit")
+            return entry
+
+    def put(self, prompt, entry):
+        with self._lock:
+            self._entries[prompt] = entry
+            self._entries.move_to_end(prompt)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """返回命中统计"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "size": len(self._entries),
+            }
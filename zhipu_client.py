@@ -1,97 +1,159 @@
-import zhipuai
 import os
 from dotenv import load_dotenv
+import copy
 import json
-import re
+import time
+import metrics
+from intent_router import IntentRouter
+from json_stream import IncrementalJSONParser, parse_json_object
+from llm_cache import LLMCache
+from llm_transport import LLMTransport, CircuitOpenError
+from single_flight import SingleFlight
 
 # 加载环境变量
 load_dotenv()
 
 class ZhipuClient:
-    def __init__(self):
+    def __init__(self, cache=None, transport=None, router=None):
+        self.cache = cache if cache is not None else LLMCache()
+        # 关键词明确的输入在本地识别，不调用大模型；MUSIC_LOCAL_ROUTER=0 关闭
+        if router is None and os.getenv("MUSIC_LOCAL_ROUTER", "1") != "0":
+            router = IntentRouter()
+        self.router = router
         self.api_key = os.getenv("ZHIPUAI_API_KEY")
+        self.transport = transport
+        # 相同输入的分析/优化请求同时到达时只调用一次大模型
+        self.inflight_analysis = SingleFlight("analyze")
+        self.inflight_refine = SingleFlight("refine")
         if not self.api_key:
             # 如果在部署环境中没有设置API密钥，使用模拟模式
             print("警告: 未找到ZHIPUAI_API_KEY，使用模拟模式")
             self.mock_mode = True
         else:
             self.mock_mode = False
-            zhipuai.api_key = self.api_key
+            if self.transport is None:
+                self.transport = LLMTransport(self.api_key)
     
-    def analyze_music_request(self, user_input):
-        """分析用户输入，提取音乐需求"""
+    def analyze_music_request(self, user_input, on_prompt=None):
+        """分析用户输入，提取音乐需求
+        
+        on_prompt: 可选回调，流式回复中 music_prompt 字段一完整就以该提示词调用，
+        便于在回复其余部分到达前提前开始文本编码或模型预热。
+        """
+        if self.router is not None:
+            specs = self.router.route(user_input)
+            if specs is not None:
+                print("本地识别音乐需求，跳过大模型调用")
+                return specs
+        
         if self.mock_mode:
             # 模拟模式，用于测试和演示
             return self._create_mock_response(user_input)
         
+        cache_key = self.cache.analysis_key(user_input)
+        cached = self.cache.get(cache_key)
+        if cached is not None:
+            print("命中需求分析缓存")
+            return cached
+        
+        specs, shared = self.inflight_analysis.do(cache_key, self._analyze_remote, user_input, on_prompt, cache_key)
+        if shared:
+            print("合并到进行中的相同需求分析")
+            # 各会话拿到各自的副本，互不影响
+            return copy.deepcopy(specs)
+        return specs
+    
+    def _analyze_remote(self, user_input, on_prompt, cache_key):
+        """调用大模型分析需求并写入缓存；熔断或解析失败时使用本地方案"""
+        try:
+            specs, complete = self._request_analysis(user_input, on_prompt)
+        except CircuitOpenError:
+            # 上游持续故障时不再等待，直接用本地关键词匹配
+            metrics.inc("fallbacks_total", source="llm_circuit_open")
+            return self._create_mock_response(user_input)
+        if specs is None:
+            metrics.inc("fallbacks_total", source="llm_analyze")
+            return self._create_fallback_prompt(user_input)
+        if not complete:
+            # 回复被截断：已完成的字段照用，缺的用备用方案补齐，但不写入缓存
+            metrics.inc("fallbacks_total", source="llm_truncated")
+            return {**self._create_fallback_prompt(user_input), **specs}
+        
+        self.cache.put(cache_key, specs)
+        return specs
+    
+    def _request_analysis(self, user_input, on_prompt=None):
+        """以流式方式调用智谱AI分析需求，返回 (需求, 是否为完整的JSON对象)；失败时需求为None"""
         prompt = f"""
         你是一个专业的音乐制作AI助手。请分析用户的音乐需求，并返回JSON格式的分析结果。
         
         用户描述："{user_input}"
         
-        请返回以下JSON格式：
+        请返回以下JSON格式（music_prompt 放在最前面）：
         {{
+            "music_prompt": "用于音乐生成模型的详细英文提示词，描述风格、乐器、情绪和节奏",
             "style": "音乐风格（如：流行、电子、古典、爵士、摇滚、古风、轻音乐等）",
             "mood": "情绪（如：欢快、悲伤、激昂、轻松、浪漫、紧张、舒缓等）", 
             "instruments": ["主要乐器1", "主要乐器2", "主要乐器3"],
             "tempo": "节奏描述（如：快速、中等、慢速、渐快、渐慢）",
-            "duration": 20,
-            "music_prompt": "用于音乐生成模型的详细英文提示词，描述风格、乐器、情绪和节奏"
+            "duration": 20
         }}
         
         示例：
         用户输入："想要一首在海边散步时听的轻松音乐"
         输出：
         {{
+            "music_prompt": "Relaxing beach walk music with gentle piano melody, soft string accompaniment, and subtle ocean wave sounds, creating a peaceful and soothing atmosphere, slow tempo",
             "style": "轻音乐",
             "mood": "轻松、惬意",
             "instruments": ["钢琴", "弦乐", "海浪声"],
             "tempo": "慢速",
-            "duration": 20,
-            "music_prompt": "Relaxing beach walk music with gentle piano melody, soft string accompaniment, and subtle ocean wave sounds, creating a peaceful and soothing atmosphere, slow tempo"
+            "duration": 20
         }}
         
         用户输入："激昂的战斗游戏配乐"
         输出：
         {{
+            "music_prompt": "Epic battle music with powerful orchestra, dramatic drums, and choir vocals, creating intense and heroic atmosphere, fast tempo",
             "style": "史诗音乐",
             "mood": "激昂、紧张",
             "instruments": ["管弦乐", "鼓", "合唱"],
             "tempo": "快速",
-            "duration": 20,
-            "music_prompt": "Epic battle music with powerful orchestra, dramatic drums, and choir vocals, creating intense and heroic atmosphere, fast tempo"
+            "duration": 20
         }}
         """
         
         try:
-            response = zhipuai.model_api.invoke(
-                model="chatglm_pro",  # 可以使用 chatglm_std 或 chatglm_pro
-                prompt=[{"role": "user", "content": prompt}],
-                top_p=0.7,
-                temperature=0.9,
-            )
+            parser = IncrementalJSONParser()
+            chunks = []
+            start = time.perf_counter()
+            with metrics.span("llm_call"):
+                for piece in self.transport.stream_invoke(
+                    model="chatglm_pro",  # 可以使用 chatglm_std 或 chatglm_pro
+                    prompt=[{"role": "user", "content": prompt}],
+                    top_p=0.7,
+                    temperature=0.9,
+                ):
+                    chunks.append(piece)
+                    for key, value in parser.feed(piece):
+                        if key == "music_prompt" and value and on_prompt is not None:
+                            metrics.observe("stage_duration_seconds", time.perf_counter() - start,
+                                            stage="llm_prompt_ready")
+                            on_prompt(value)
             
-            if response['code'] == 200:
-                content = response['data']['choices'][0]['content']
-                print(f"智谱AI原始响应: {content}")
-                
-                # 提取JSON部分
-                json_match = re.search(r'\{.*\}', content, re.DOTALL)
-                if json_match:
-                    json_str = json_match.group()
-                    # 处理可能的JSON格式问题
-                    json_str = json_str.replace("'", '"')
-                    return json.loads(json_str)
-                else:
-                    print("未找到JSON格式响应，使用备用方案")
-                    return self._create_fallback_prompt(user_input)
-            else:
-                print(f"API调用失败: {response}")
-                return self._create_fallback_prompt(user_input)
+            print(f"智谱AI原始响应: {''.join(chunks)}")
+            specs = parser.result()
+            if specs is None:
+                print("未找到JSON格式响应，使用备用方案")
+            elif not parser.complete:
+                print("智谱AI回复不完整，只取到部分字段")
+            return specs, parser.complete
                 
+        except CircuitOpenError:
+            raise
         except Exception as e:
             print(f"调用智谱AI时出错: {e}")
-            return self._create_fallback_prompt(user_input)
+            return None, False
     
     def _create_mock_response(self, user_input):
         """创建模拟响应（当没有API密钥时使用）"""
@@ -158,16 +220,21 @@ class ZhipuClient:
     def refine_with_feedback(self, original_specs, user_feedback):
         """根据用户反馈优化音乐描述"""
         if self.mock_mode:
-            # 在模拟模式下简单调整
-            new_specs = original_specs.copy()
-            if "快" in user_feedback:
-                new_specs["tempo"] = "快速"
-                new_specs["music_prompt"] = new_specs["music_prompt"].replace("medium tempo", "fast tempo").replace("slow tempo", "fast tempo")
-            elif "慢" in user_feedback:
-                new_specs["tempo"] = "慢速" 
-                new_specs["music_prompt"] = new_specs["music_prompt"].replace("fast tempo", "slow tempo").replace("medium tempo", "slow tempo")
-            return new_specs
+            return self._create_mock_refinement(original_specs, user_feedback)
+        
+        cache_key = self.cache.refine_key(original_specs, user_feedback)
+        cached = self.cache.get(cache_key)
+        if cached is not None:
+            print("命中反馈优化缓存")
+            return cached
         
+        new_specs, shared = self.inflight_refine.do(
+            cache_key, self._refine_remote, original_specs, user_feedback, cache_key
+        )
+        return copy.deepcopy(new_specs) if shared else new_specs
+    
+    def _refine_remote(self, original_specs, user_feedback, cache_key):
+        """调用大模型按反馈调整描述并写入缓存；失败时返回原始描述"""
         prompt = f"""
         原始音乐描述：
         {json.dumps(original_specs, ensure_ascii=False, indent=2)}
@@ -179,23 +246,44 @@ class ZhipuClient:
         """
         
         try:
-            response = zhipuai.model_api.invoke(
-                model="chatglm_pro",
-                prompt=[{"role": "user", "content": prompt}],
-                top_p=0.7,
-                temperature=0.7,
-            )
+            with metrics.span("llm_call"):
+                response = self.transport.invoke(
+                    model="chatglm_pro",
+                    prompt=[{"role": "user", "content": prompt}],
+                    top_p=0.7,
+                    temperature=0.7,
+                )
             
             if response['code'] == 200:
                 content = response['data']['choices'][0]['content']
-                json_match = re.search(r'\{.*\}', content, re.DOTALL)
-                if json_match:
-                    json_str = json_match.group()
-                    json_str = json_str.replace("'", '"')
-                    return json.loads(json_str)
+                new_specs = self._extract_json(content)
+                if new_specs is not None:
+                    self.cache.put(cache_key, new_specs)
+                    return new_specs
             
+            metrics.inc("fallbacks_total", source="llm_refine")
             return original_specs  # 如果解析失败，返回原始描述
             
+        except CircuitOpenError:
+            metrics.inc("fallbacks_total", source="llm_circuit_open")
+            return self._create_mock_refinement(original_specs, user_feedback)
         except Exception as e:
             print(f"优化描述时出错: {e}")
-            return original_specs
\ No newline at end of file
+            metrics.inc("fallbacks_total", source="llm_refine")
+            return original_specs
+    
+    def _create_mock_refinement(self, original_specs, user_feedback):
+        """按反馈中的快慢关键词简单调整（模拟模式和熔断时使用）"""
+        new_specs = original_specs.copy()
+        if "快" in user_feedback:
+            new_specs["tempo"] = "快速"
+            new_specs["music_prompt"] = new_specs["music_prompt"].replace("medium tempo", "fast tempo").replace("slow tempo", "fast tempo")
+        elif "慢" in user_feedback:
+            new_specs["tempo"] = "慢速" 
+            new_specs["music_prompt"] = new_specs["music_prompt"].replace("fast tempo", "slow tempo").replace("medium tempo", "slow tempo")
+        return new_specs
+    
+    def _extract_json(self, content):
+        """从模型回复中提取JSON，找不到时返回None"""
+        with metrics.span("json_extract"):
+            return parse_json_object(content)
\ No newline at end of file